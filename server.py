@@ -1,12 +1,88 @@
 #!/usr/bin/env python3
+import abc
+import asyncio
+import atexit
+import base64
+import cProfile
+import contextlib
+import contextvars
+import functools
+import hashlib
+import hmac
+import inspect
+import io
 import json
+import logging
+import logging.handlers
+import marshal
+import math
 import os
-from typing import Optional, Dict, Any, List
+import pstats
+import queue
+import random
+import re
+import struct
+import sys
+import tempfile
+import time
+import uuid
+import zlib
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from typing import Optional, Dict, Any, List, Literal, Tuple, Set, Iterator, AsyncIterator
 import httpx
 from dotenv import load_dotenv
 from pydantic import BaseModel, Field
 from fastmcp import FastMCP
+from fastmcp.exceptions import ResourceError, ToolError
+from fastmcp.server.dependencies import get_http_request
+from fastmcp.server.middleware import Middleware, MiddlewareContext
+from fastmcp.tools.tool import ToolResult
+from mcp.types import (
+    ImageContent,
+    ResourceUpdatedNotification,
+    ResourceUpdatedNotificationParams,
+    ServerNotification,
+)
 from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+try:
+    from pyinstrument import Profiler
+    from pyinstrument.renderers import SpeedscopeRenderer
+except ImportError:
+    Profiler = None
 
 
 load_dotenv()
@@ -14,11 +90,105 @@ load_dotenv()
 API_KEY = os.getenv("PORCUS_LARDUM_API_KEY", "")
 BASE_URL = os.getenv("PORCUS_LARDUM_BASE_URL", "https://porcus-lardum-func-dev.azurewebsites.net")
 PRODIGI_API_KEY = os.getenv("PRODIGI_API_KEY", "")
+MCP_PATH = "/mcp"
+MOCKUP_CATALOG_URL = "https://blender-mockups-func-dev.azurewebsites.net/api/json"
+CATALOG_TTL_SECONDS = float(os.getenv("CATALOG_TTL_SECONDS", "300"))
+PRODIGI_BASE_URL = "https://api.sandbox.prodigi.com/v4.0"
+PRODUCT_TTL_SECONDS = float(os.getenv("PRODUCT_TTL_SECONDS", "3600"))
+# Indexed product specs kept in this process; the raw products stay in the shared cache
+PRODUCT_SPECS_MAX = int(os.getenv("PRODUCT_SPECS_MAX", "1000"))
+UPSTREAM_MAX_CONCURRENCY_PER_HOST = int(os.getenv("UPSTREAM_MAX_CONCURRENCY_PER_HOST", "16"))
+UPSTREAM_MAX_CONNECTIONS = 100
+# Idle upstream connections are kept this long so warm connections survive between calls
+UPSTREAM_KEEPALIVE_SECONDS = float(os.getenv("UPSTREAM_KEEPALIVE_SECONDS", "120"))
+SCHEMA_TTL_SECONDS = float(os.getenv("SCHEMA_TTL_SECONDS", "3600"))
+# Resources clients have read are re-checked this often, so changes can be notified
+RESOURCE_REFRESH_SECONDS = float(os.getenv("RESOURCE_REFRESH_SECONDS", "60"))
+RESOURCE_READERS_MAX = 10000
+RESOURCE_VERSIONS_MAX = 10000
+# /readyz reports not ready past any of these saturation thresholds
+READY_MAX_LOOP_LAG_MS = float(os.getenv("READY_MAX_LOOP_LAG_MS", "250"))
+READY_MAX_INFLIGHT_CALLS = int(os.getenv("READY_MAX_INFLIGHT_CALLS", "200"))
+READY_MAX_POOL_UTILIZATION = float(os.getenv("READY_MAX_POOL_UTILIZATION", "0.9"))
+READY_MAX_UPSTREAM_WAITING = int(os.getenv("READY_MAX_UPSTREAM_WAITING", "50"))
+LOOP_LAG_INTERVAL_SECONDS = 0.5
+# Startup warmup: open upstream connections and prefetch caches, within a time budget
+WARMUP_ENABLED = os.getenv("MCP_WARMUP", "true").lower() in ("1", "true", "yes")
+WARMUP_BUDGET_SECONDS = float(os.getenv("WARMUP_BUDGET_SECONDS", "5"))
+WARMUP_SKUS = [sku.strip() for sku in os.getenv("WARMUP_SKUS", "").split(",") if sku.strip()]
+# Longest a tool call may run; clients can ask for less with `_meta.timeout_seconds`
+TOOL_CALL_TIMEOUT_SECONDS = float(os.getenv("TOOL_CALL_TIMEOUT_SECONDS", "120"))
+# Requests with a matching X-Profile-Token header are profiled; unset disables profiling entirely
+PROFILING_TOKEN = os.getenv("MCP_PROFILING_TOKEN", "")
+PROFILES_MAX_STORED = int(os.getenv("PROFILES_MAX_STORED", "20"))
+# /healthz and /readyz include their full diagnostics, and /metrics answers, only for a matching
+# X-Health-Token header
+HEALTH_TOKEN = os.getenv("MCP_HEALTH_TOKEN", "")
+# Nested unit-tagged parameters and one-line tool descriptions in tools/list
+COMPACT_MANIFEST = os.getenv("MCP_COMPACT_MANIFEST", "false").lower() in ("1", "true", "yes")
+
+# Output inspection streams blobs in chunks so large print files never sit in memory
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", str(1024 * 1024)))
+HEADER_PROBE_BYTES = int(os.getenv("HEADER_PROBE_BYTES", str(256 * 1024)))
+PDF_TAIL_PROBE_BYTES = int(os.getenv("PDF_TAIL_PROBE_BYTES", str(64 * 1024)))
+# Sync transforms stream results into blobs in blocks of this size, or inline up to the cap
+SYNC_BLOCK_SIZE = int(os.getenv("SYNC_BLOCK_SIZE", str(4 * 1024 * 1024)))
+SYNC_INLINE_MAX_BYTES = int(os.getenv("SYNC_INLINE_MAX_BYTES", str(1024 * 1024)))
+# Identical transform submissions join the queued job, or reuse its output while the blob is valid
+RESULT_CACHE_TTL_SECONDS = float(os.getenv("RESULT_CACHE_TTL_SECONDS", "3600"))
+# A job whose output is still missing after this long is assumed failed and resubmitted
+RESULT_JOB_GRACE_SECONDS = float(os.getenv("RESULT_JOB_GRACE_SECONDS", "300"))
+RESULT_MIN_VALIDITY_SECONDS = 300
+# PDFs split into page chunks are held in memory up to this size, then spilled to disk
+PDF_SPOOL_MAX_BYTES = int(os.getenv("PDF_SPOOL_MAX_BYTES", str(32 * 1024 * 1024)))
+PDF_CHUNK_POLL_SECONDS = 2.0
+# Chunks of one PDF uploaded, transformed or downloaded at the same time
+PDF_CHUNK_CONCURRENCY = int(os.getenv("PDF_CHUNK_CONCURRENCY", "4"))
+# Downscaled previews for preview_image, kept in a small in-process LRU
+PREVIEW_CACHE_ENTRIES = int(os.getenv("PREVIEW_CACHE_ENTRIES", "64"))
+PREVIEW_CACHE_TTL_SECONDS = float(os.getenv("PREVIEW_CACHE_TTL_SECONDS", "600"))
+PREVIEW_MAX_SIZE = 1024
+# Sources larger than this are not downloaded for a preview
+PREVIEW_MAX_SOURCE_BYTES = int(os.getenv("PREVIEW_MAX_SOURCE_BYTES", str(200 * 1024 * 1024)))
+PREVIEW_JPEG_QUALITY = 80
+# Hosts inspect_output_image and preview_image may fetch from; "*." entries match any subdomain
+FETCH_ALLOWED_HOSTS = [
+    host.strip().lower()
+    for host in os.getenv("FETCH_ALLOWED_HOSTS", "*.blob.core.windows.net").split(",")
+    if host.strip()
+]
+# JSON and text responses at least this large are compressed when the client accepts it
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "1024"))
+# Hedge idempotent upstream GETs slower than the endpoint's HEDGE_PERCENTILE latency,
+# sending at most HEDGE_BUDGET extra requests per request
+HEDGING_ENABLED = os.getenv("MCP_HEDGING", "false").lower() in ("1", "true", "yes")
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_BUDGET = float(os.getenv("HEDGE_BUDGET", "0.05"))
+HEDGE_MAX_BURST = 10
+HEDGE_MIN_SAMPLES = 20
+HEDGE_SAMPLE_SIZE = 500
+HEDGE_MIN_DELAY_SECONDS = 0.02
+# Shared cache: a Redis-protocol server when CACHE_URL is set (redis://, rediss://), else in-process
+CACHE_URL = os.getenv("CACHE_URL", "")
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+CACHE_COMPRESS_THRESHOLD = 1024
+# Structured logs go through a bounded queue; sampling applies to successful tool calls only
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# Fraction of successful calls logged per tool, e.g. "search_mockup_catalog=0.1"
+LOG_SAMPLE_RATES = {
+    name.strip(): float(rate)
+    for name, _, rate in (item.partition("=") for item in os.getenv("LOG_SAMPLE_RATES", "").split(","))
+    if name.strip() and rate.strip()
+}
+# JSON bodies above this size are parsed in a worker thread instead of on the event loop
+JSON_OFFLOAD_THRESHOLD = int(os.getenv("JSON_OFFLOAD_THRESHOLD", str(256 * 1024)))
+# Dont use session ids...
+STATELESS_HTTP = True
 
 mcp = FastMCP(
     "Porcus Lardum Image Transformer",
-    # Dont use session ids...
-    stateless_http=True
+    stateless_http=STATELESS_HTTP
 )
 
 
@@ -61,225 +231,2229 @@ class ImageOpsTransformParamsIn(BaseModel):
         None, description="Custom transform sequence array"
     )
 
-class MockupParameters(BaseModel):
-    size: List[int] = Field(description="Output dimensions [width, height] in pixels")
-    sku: str = Field(description="Product SKU identifier")
-    camera: str = Field(description="Camera angle (e.g., 'HeadOn', 'Perspective')")
-    orientation: Optional[str] = Field(None, description="Product orientation ('portrait' or 'landscape')")
-    color: Optional[str] = Field(None, description="Product color variant")
-    wrap: Optional[str] = Field(None, description="Image application method")
-    finish: Optional[str] = Field(None, description="Product surface finish")
-    blank: Optional[bool] = Field(None, description="Generate empty product preview")
+class MockupParameters(BaseModel):
+    size: List[int] = Field(description="Output dimensions [width, height] in pixels")
+    sku: str = Field(description="Product SKU identifier")
+    camera: str = Field(description="Camera angle (e.g., 'HeadOn', 'Perspective')")
+    orientation: Optional[str] = Field(None, description="Product orientation ('portrait' or 'landscape')")
+    color: Optional[str] = Field(None, description="Product color variant")
+    wrap: Optional[str] = Field(None, description="Image application method")
+    finish: Optional[str] = Field(None, description="Product surface finish")
+    blank: Optional[bool] = Field(None, description="Generate empty product preview")
+
+class MockupRequest(BaseModel):
+    source_image_url: Optional[str] = Field(None, description="User image to apply to product")
+    output_image_url: str = Field(description="URL where mockup will be delivered")
+    parameters: MockupParameters = Field(description="Mockup generation parameters")
+
+class UnitValues(BaseModel):
+    unit: Literal["pixels", "mm", "inches"] = Field(description="Unit of the values")
+    values: List[float] = Field(description="Values in the given unit")
+
+class UnitValue(BaseModel):
+    unit: Literal["pixels", "mm", "inches"] = Field(description="Unit of the value")
+    value: float = Field(description="Value in the given unit")
+
+class CropBoxIn(BaseModel):
+    unit: Literal["pixels", "mm", "inches"] = Field(description="Unit of size and offset")
+    size: List[float] = Field(description="Region [width, height]")
+    offset: Optional[List[float]] = Field(None, description="Region offset [x, y], default 0,0")
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+_PDF_PAGES_COUNT_RE = re.compile(
+    rb"/Type\s*/Pages\b(?:(?!>>).)*?/Count\s+(\d+)|/Count\s+(\d+)(?:(?!>>).)*?/Type\s*/Pages\b",
+    re.S,
+)
+_PDF_LINEARIZED_RE = re.compile(rb"/Linearized\b[^>]*?/N\s+(\d+)", re.S)
+_PDF_MEDIABOX_RE = re.compile(
+    rb"/MediaBox\s*\[\s*(-?[\d.]+)\s+(-?[\d.]+)\s+(-?[\d.]+)\s+(-?[\d.]+)\s*\]"
+)
+
+
+def _json_dumps(value: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(",", ":")).encode()
+
+
+def _json_loads(data: Any) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+async def _json_loads_off_loop(content: bytes) -> Any:
+    """Parses JSON, in a worker thread when it is large enough to stall the event loop."""
+    if len(content) > JSON_OFFLOAD_THRESHOLD:
+        return await asyncio.to_thread(_json_loads, content)
+    return _json_loads(content)
+
+
+async def _parse_json(response: httpx.Response) -> Any:
+    return await _json_loads_off_loop(response.content)
+
+
+# Logging: records are queued on the event loop and written by a background thread
+
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            **getattr(record, "fields", {}),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return _json_dumps(entry).decode()
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Drops records when the queue is full rather than blocking or raising on the event loop."""
+
+    dropped = 0
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _DroppingQueueHandler.dropped += 1
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Formatting happens on the listener thread; only resolve the message here
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+logger = logging.getLogger("porcus_lardum")
+logger.setLevel(LOG_LEVEL)
+logger.propagate = False
+_log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(LOG_QUEUE_SIZE)
+logger.addHandler(_DroppingQueueHandler(_log_queue))
+_log_output = logging.StreamHandler(sys.stdout)
+_log_output.setFormatter(_JsonFormatter())
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_output)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+
+# Upstream requests made during the current tool call, collected for its access log record
+_call_upstream: contextvars.ContextVar[Optional[List[Dict[str, Any]]]] = contextvars.ContextVar(
+    "call_upstream", default=None
+)
+
+
+async def _record_request_start(request: httpx.Request) -> None:
+    request.extensions["started_at"] = time.monotonic()
+
+
+async def _record_upstream_response(response: httpx.Response) -> None:
+    calls = _call_upstream.get()
+    if calls is None:
+        return
+    started_at = response.request.extensions.get("started_at")
+    calls.append({
+        "host": response.request.url.host,
+        "method": response.request.method,
+        "status": response.status_code,
+        "duration_ms": round((time.monotonic() - started_at) * 1000, 1) if started_at else None,
+    })
+
+
+def _cache_encode(data: bytes) -> bytes:
+    if len(data) > CACHE_COMPRESS_THRESHOLD:
+        return b"z" + zlib.compress(data)
+    return b"j" + data
+
+
+def _cache_decode(data: bytes) -> Any:
+    if data[:1] == b"z":
+        return _json_loads(zlib.decompress(data[1:]))
+    return _json_loads(data[1:])
+
+
+class CacheBackend(abc.ABC):
+    """Key/value cache with TTLs for the catalog, product specs, SKU checks and transform jobs.
+    
+    Values are JSON-compatible. `set_if_absent` is atomic, so it can serve as a lock
+    between instances.
+    """
+
+    @abc.abstractmethod
+    async def get(self, key: str) -> Any:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def set(self, key: str, value: Any, ttl: float) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def set_if_absent(self, key: str, value: Any, ttl: float) -> bool:
+        """Stores the value only if the key is missing; returns whether it was stored."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+
+class MemoryCache(CacheBackend):
+    """In-process cache, evicting the least recently used keys beyond `max_entries`.
+    
+    Values are kept as-is rather than serialized, so they must not be mutated once stored.
+    """
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+
+    def _live(self, key: str) -> Optional[Tuple[float, Any]]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    async def get(self, key: str) -> Any:
+        entry = self._live(key)
+        return None if entry is None else entry[1]
+
+    async def set(self, key: str, value: Any, ttl: float) -> None:
+        self.entries[key] = (time.monotonic() + ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def set_if_absent(self, key: str, value: Any, ttl: float) -> bool:
+        if self._live(key) is not None:
+            return False
+        await self.set(key, value, ttl)
+        return True
+
+    async def delete(self, key: str) -> None:
+        self.entries.pop(key, None)
+
+
+class RedisCache(CacheBackend):
+    """Cache on a Redis-protocol server shared by every instance.
+    
+    Values are stored as JSON, zlib-compressed above CACHE_COMPRESS_THRESHOLD bytes. While the
+    server is unreachable, reads and writes go to an in-process `fallback` cache and locks are
+    refused, so callers fetch for themselves rather than failing or assuming a lock is held.
+    """
+
+    def __init__(self, client, prefix: str = "porcus-lardum:", fallback: Optional[MemoryCache] = None):
+        self.client = client
+        self.prefix = prefix
+        self.fallback = fallback or MemoryCache(CACHE_MAX_ENTRIES)
+
+    @classmethod
+    def from_url(cls, url: str) -> "RedisCache":
+        return cls(aioredis.from_url(url))
+
+    async def get(self, key: str) -> Any:
+        try:
+            data = await self.client.get(self.prefix + key)
+        except (aioredis.RedisError, OSError) as e:
+            logger.warning("Cache get failed: %s", e)
+            return await self.fallback.get(key)
+        if data is None:
+            return None
+        if len(data) > JSON_OFFLOAD_THRESHOLD:
+            return await asyncio.to_thread(_cache_decode, data)
+        return _cache_decode(data)
+
+    async def _set(self, key: str, value: Any, ttl: float, only_if_absent: bool) -> bool:
+        data = _json_dumps(value)
+        if len(data) > JSON_OFFLOAD_THRESHOLD:
+            data = await asyncio.to_thread(_cache_encode, data)
+        else:
+            data = _cache_encode(data)
+        try:
+            return bool(await self.client.set(
+                self.prefix + key, data, px=max(1, int(ttl * 1000)), nx=only_if_absent
+            ))
+        except (aioredis.RedisError, OSError) as e:
+            logger.warning("Cache set failed: %s", e)
+            if only_if_absent:
+                return False
+            await self.fallback.set(key, value, ttl)
+            return True
+
+    async def set(self, key: str, value: Any, ttl: float) -> None:
+        await self._set(key, value, ttl, only_if_absent=False)
+
+    async def set_if_absent(self, key: str, value: Any, ttl: float) -> bool:
+        return await self._set(key, value, ttl, only_if_absent=True)
+
+    async def delete(self, key: str) -> None:
+        await self.fallback.delete(key)
+        try:
+            await self.client.delete(self.prefix + key)
+        except (aioredis.RedisError, OSError) as e:
+            logger.warning("Cache delete failed: %s", e)
+
+
+def _make_cache() -> CacheBackend:
+    if not CACHE_URL:
+        return MemoryCache(CACHE_MAX_ENTRIES)
+    if aioredis is None:
+        raise RuntimeError("CACHE_URL is set but the redis package is not installed")
+    return RedisCache.from_url(CACHE_URL)
+
+
+_cache = _make_cache()
+
+
+# Encodings httpx can decode with the packages installed, preferring the smallest
+_UPSTREAM_ACCEPT_ENCODING = ", ".join(
+    encoding for encoding, available in (("zstd", zstandard), ("br", brotli), ("gzip", True), ("deflate", True))
+    if available
+)
+
+
+# One pooled client per event loop, so upstream connections are reused across tool calls
+_shared_client: Optional[httpx.AsyncClient] = None
+_shared_client_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+class _CountingTransport(httpx.AsyncBaseTransport):
+    """Counts upstream requests from when they are sent until their response is closed.
+    
+    Requests waiting for a pooled connection are included, so the count can exceed
+    UPSTREAM_MAX_CONNECTIONS.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport):
+        self.transport = transport
+        self.in_flight = 0
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.in_flight += 1
+        try:
+            response = await self.transport.handle_async_request(request)
+        except BaseException:
+            self.in_flight -= 1
+            raise
+        response.stream = _CountedStream(response.stream, self)
+        return response
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+class _CountedStream(httpx.AsyncByteStream):
+    def __init__(self, stream: httpx.AsyncByteStream, transport: _CountingTransport):
+        self.stream = stream
+        self.transport = transport
+        self.closed = False
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        if not self.closed:
+            self.closed = True
+            self.transport.in_flight -= 1
+        await self.stream.aclose()
+
+
+# Transport of the shared client, counting its upstream requests for /readyz
+_upstream_transport: Optional[_CountingTransport] = None
+
+
+def _http_client() -> httpx.AsyncClient:
+    global _shared_client, _shared_client_loop, _upstream_transport
+    loop = asyncio.get_running_loop()
+    if _shared_client is None or _shared_client.is_closed or _shared_client_loop is not loop:
+        _upstream_transport = _CountingTransport(httpx.AsyncHTTPTransport(
+            limits=httpx.Limits(
+                max_connections=UPSTREAM_MAX_CONNECTIONS,
+                max_keepalive_connections=UPSTREAM_MAX_CONCURRENCY_PER_HOST * 4,
+                keepalive_expiry=UPSTREAM_KEEPALIVE_SECONDS,
+            ),
+        ))
+        _shared_client = httpx.AsyncClient(
+            transport=_upstream_transport,
+            headers={"Accept-Encoding": _UPSTREAM_ACCEPT_ENCODING},
+            event_hooks={"request": [_record_request_start], "response": [_record_upstream_response]},
+        )
+        _shared_client_loop = loop
+    return _shared_client
+
+
+@contextlib.asynccontextmanager
+async def _upstream_client():
+    """Yields the shared client; unlike `httpx.AsyncClient()` it stays open afterwards."""
+    yield _http_client()
+
+
+# Monotonic deadline of the tool call being served, set by DeadlineMiddleware
+_call_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("call_deadline", default=None)
+
+
+def _upstream_timeout(default: float) -> float:
+    """Caps an upstream request timeout at the time left before the tool call's deadline."""
+    deadline = _call_deadline.get()
+    if deadline is None:
+        return default
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise TimeoutError("Tool call deadline exceeded")
+    return min(default, remaining)
+
+
+def _start_shared(coro) -> asyncio.Task:
+    """Starts work shared by several tool calls, free of the starting call's deadline."""
+    context = contextvars.copy_context()
+    context.run(_call_deadline.set, None)
+    return context.run(asyncio.ensure_future, coro)
+
+
+async def _join_shared(task: asyncio.Task) -> Any:
+    """Awaits shared work until the calling tool's own deadline, leaving it running for the others."""
+    deadline = _call_deadline.get()
+    if deadline is None:
+        return await asyncio.shield(task)
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), max(0.0, deadline - time.monotonic()))
+    except asyncio.TimeoutError:
+        raise TimeoutError("Tool call deadline exceeded") from None
+
+
+async def _close_http_client() -> None:
+    global _shared_client
+    if _shared_client is not None and not _shared_client.is_closed:
+        await _shared_client.aclose()
+    _shared_client = None
+
+
+class _EndpointStats:
+    """Recent latencies and hedging counters for one upstream endpoint."""
+
+    def __init__(self):
+        self.latencies: deque = deque(maxlen=HEDGE_SAMPLE_SIZE)
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        # Each request earns HEDGE_BUDGET of a hedge, which caps the extra load at that ratio
+        self.tokens = 0.0
+
+    def percentile(self, percent: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+    def hedge_delay(self) -> Optional[float]:
+        if not HEDGING_ENABLED or len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        return max(HEDGE_MIN_DELAY_SECONDS, self.percentile(HEDGE_PERCENTILE))
+
+    def metrics(self) -> Dict[str, Any]:
+        def ms(value: Optional[float]) -> Optional[float]:
+            return None if value is None else round(value * 1000, 1)
+        return {
+            "requests": self.requests,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "hedge_rate": round(self.hedged / self.requests, 4) if self.requests else 0.0,
+            "win_rate": round(self.hedge_wins / self.hedged, 4) if self.hedged else 0.0,
+            "hedge_delay_ms": ms(self.hedge_delay()),
+            "p50_ms": ms(self.percentile(50)),
+            "p99_ms": ms(self.percentile(99)),
+        }
+
+
+_endpoint_stats: Dict[str, _EndpointStats] = {}
+
+
+def _discard_response(task: asyncio.Task) -> None:
+    # Close the losing response so its connection goes back to the pool
+    if not task.cancelled() and task.exception() is None:
+        asyncio.ensure_future(task.result().aclose())
+
+
+async def _hedged_get(endpoint: str, url: str, **kwargs) -> httpx.Response:
+    """GETs an idempotent upstream resource, hedging slow requests when MCP_HEDGING is on.
+    
+    If no response has arrived after the endpoint's HEDGE_PERCENTILE latency, an identical
+    request is sent; the first successful response wins and the other is cancelled.
+    """
+    client = _http_client()
+    stats = _endpoint_stats.setdefault(endpoint, _EndpointStats())
+    stats.requests += 1
+    stats.tokens = min(HEDGE_MAX_BURST, stats.tokens + HEDGE_BUDGET)
+    started = time.monotonic()
+    delay = stats.hedge_delay()
+    
+    def send() -> asyncio.Task:
+        return asyncio.ensure_future(client.send(client.build_request("GET", url, **kwargs)))
+    
+    primary = send()
+    pending = {primary}
+    try:
+        done, _ = await asyncio.wait(pending, timeout=delay)
+        hedge = None
+        if not done and stats.tokens >= 1:
+            stats.tokens -= 1
+            stats.hedged += 1
+            hedge = send()
+            pending.add(hedge)
+        
+        while True:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winner = next((task for task in done if task.exception() is None), None)
+            if winner is not None or not pending:
+                break
+        if winner is None:
+            raise next(iter(done)).exception()
+        
+        if winner is hedge:
+            stats.hedge_wins += 1
+        # When the hedge wins this is a lower bound on the primary's latency
+        stats.latencies.append(time.monotonic() - started)
+        for task in done - {winner}:
+            _discard_response(task)
+        return winner.result()
+    finally:
+        for task in pending:
+            task.cancel()
+            task.add_done_callback(_discard_response)
+
+
+def _parse_png_header(data: bytes):
+    width, height = struct.unpack(">II", data[16:24])
+    metadata = {"format": "png", "width": width, "height": height, "dpi": None}
+    offset = 8
+    while offset + 8 <= len(data):
+        length, chunk_type = struct.unpack(">I4s", data[offset:offset + 8])
+        if chunk_type == b"pHYs":
+            if offset + 17 > len(data):
+                break
+            x_ppu, y_ppu, unit = struct.unpack(">IIB", data[offset + 8:offset + 17])
+            if unit == 1:
+                # Pixels per meter
+                metadata["dpi"] = [round(x_ppu * 0.0254), round(y_ppu * 0.0254)]
+            return metadata, True
+        if chunk_type in (b"IDAT", b"IEND"):
+            # pHYs must precede the image data, so nothing more to find
+            return metadata, True
+        offset += 12 + length
+    return metadata, False
+
+
+def _parse_jpeg_header(data: bytes):
+    metadata = {"format": "jpeg", "width": None, "height": None, "dpi": None}
+    offset = 2
+    while offset + 4 <= len(data):
+        if data[offset] != 0xFF:
+            return metadata, True
+        marker = data[offset + 1]
+        if marker == 0xFF:
+            offset += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            offset += 2
+            continue
+        length = struct.unpack(">H", data[offset + 2:offset + 4])[0]
+        segment = data[offset + 4:offset + 2 + length]
+        if len(segment) < length - 2:
+            break
+        if marker == 0xE0 and segment[:5] == b"JFIF\x00" and len(segment) >= 12:
+            units = segment[7]
+            x_density, y_density = struct.unpack(">HH", segment[8:12])
+            if units == 1:
+                metadata["dpi"] = [x_density, y_density]
+            elif units == 2:
+                metadata["dpi"] = [round(x_density * 2.54), round(y_density * 2.54)]
+        elif marker in _JPEG_SOF_MARKERS and len(segment) >= 6:
+            height, width = struct.unpack(">HH", segment[1:5])
+            metadata.update(width=width, height=height, components=segment[5])
+            return metadata, True
+        elif marker == 0xDA:
+            return metadata, True
+        offset += 2 + length
+    return metadata, False
+
+
+def _parse_webp_header(data: bytes):
+    metadata = {"format": "webp", "width": None, "height": None, "dpi": None}
+    if len(data) < 30:
+        return metadata, False
+    chunk = data[12:16]
+    if chunk == b"VP8X":
+        metadata["width"] = 1 + int.from_bytes(data[24:27], "little")
+        metadata["height"] = 1 + int.from_bytes(data[27:30], "little")
+    elif chunk == b"VP8L":
+        bits = int.from_bytes(data[21:25], "little")
+        metadata["width"] = (bits & 0x3FFF) + 1
+        metadata["height"] = ((bits >> 14) & 0x3FFF) + 1
+    elif chunk == b"VP8 ":
+        metadata["width"] = struct.unpack("<H", data[26:28])[0] & 0x3FFF
+        metadata["height"] = struct.unpack("<H", data[28:30])[0] & 0x3FFF
+    return metadata, True
+
+
+class _PdfScanner:
+    """Incrementally scans PDF bytes for page count and first page size."""
+
+    _OVERLAP = 1024
+
+    def __init__(self):
+        self.version = None
+        self.page_count = None
+        self.linearized_page_count = None
+        self.media_box = None
+        self._tail = b""
+
+    def feed(self, chunk: bytes) -> None:
+        window = self._tail + chunk
+        if self.version is None and window.startswith(b"%PDF-"):
+            self.version = window[5:8].decode("ascii", "replace")
+        if self.linearized_page_count is None:
+            match = _PDF_LINEARIZED_RE.search(window)
+            if match:
+                self.linearized_page_count = int(match.group(1))
+        if self.media_box is None:
+            match = _PDF_MEDIABOX_RE.search(window)
+            if match:
+                self.media_box = [float(v) for v in match.groups()]
+        for match in _PDF_PAGES_COUNT_RE.finditer(window):
+            count = int(match.group(1) or match.group(2))
+            # The root of the page tree carries the largest count
+            if self.page_count is None or count > self.page_count:
+                self.page_count = count
+        self._tail = window[-self._OVERLAP:]
+
+    @property
+    def complete(self) -> bool:
+        return self.linearized_page_count is not None and self.media_box is not None
+
+    def metadata(self) -> Dict[str, Any]:
+        metadata = {
+            "format": "pdf",
+            "pdf_version": self.version,
+            "page_count": self.linearized_page_count or self.page_count,
+            "width_pt": None,
+            "height_pt": None,
+        }
+        if self.media_box:
+            x1, y1, x2, y2 = self.media_box
+            width, height = abs(x2 - x1), abs(y2 - y1)
+            metadata.update(
+                width_pt=width,
+                height_pt=height,
+                width_inches=round(width / 72, 3),
+                height_inches=round(height / 72, 3),
+            )
+        return metadata
+
+
+def _parse_image_header(data: bytes):
+    """Returns (metadata, complete) for the leading bytes of an image, or (None, True) if unknown."""
+    if data.startswith(_PNG_SIGNATURE) and len(data) >= 24:
+        return _parse_png_header(data)
+    if data.startswith(b"\xff\xd8"):
+        return _parse_jpeg_header(data)
+    if data[:6] in (b"GIF87a", b"GIF89a") and len(data) >= 10:
+        width, height = struct.unpack("<HH", data[6:10])
+        return {"format": "gif", "width": width, "height": height, "dpi": None}, True
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return _parse_webp_header(data)
+    if len(data) < 32:
+        return None, False
+    return None, True
+
+
+class MockupCatalog:
+    """A fetched mockup catalog with lookup indexes, built once per refresh."""
+
+    # Catalog field names vary between products, so each index reads several aliases
+    INDEXED_FIELDS = {
+        "sku": ("sku", "SKU", "id"),
+        "category": ("category", "categories", "productType", "type"),
+        "camera": ("camera", "cameras"),
+        "color": ("color", "colors", "colour", "colours"),
+        "orientation": ("orientation", "orientations"),
+        "finish": ("finish", "finishes"),
+    }
+    NAME_FIELDS = ("name", "title", "productName", "sku", "SKU")
+
+    def __init__(self, data: Any, fetched_at: float):
+        self.data = data
+        self.fetched_at = fetched_at
+        self.version = hashlib.sha256(_json_dumps(data)).hexdigest()[:16]
+        self.entries = self._entries(data)
+        self.indexes: Dict[str, Dict[str, List[int]]] = {field: {} for field in self.INDEXED_FIELDS}
+        self.text_index: Dict[str, List[int]] = {}
+        for position, entry in enumerate(self.entries):
+            for field, aliases in self.INDEXED_FIELDS.items():
+                for value in self._values(entry, aliases):
+                    self.indexes[field].setdefault(value, []).append(position)
+            tokens = set()
+            for value in self._values(entry, self.NAME_FIELDS):
+                tokens.update(re.findall(r"[a-z0-9]+", value))
+            for token in tokens:
+                self.text_index.setdefault(token, []).append(position)
+
+    @staticmethod
+    def _entries(data: Any) -> List[Dict[str, Any]]:
+        if isinstance(data, list):
+            return [entry for entry in data if isinstance(entry, dict)]
+        if isinstance(data, dict):
+            for key in ("products", "mockups", "items"):
+                if isinstance(data.get(key), list):
+                    return MockupCatalog._entries(data[key])
+            # Keyed by SKU
+            return [
+                {"sku": sku, **entry} if isinstance(entry, dict) else {"sku": sku, "value": entry}
+                for sku, entry in data.items()
+            ]
+        return []
+
+    @staticmethod
+    def _values(entry: Dict[str, Any], aliases) -> set:
+        values = set()
+        sources = [entry]
+        if isinstance(entry.get("parameters"), dict):
+            sources.append(entry["parameters"])
+        for source in sources:
+            for alias in aliases:
+                value = source.get(alias)
+                items = value if isinstance(value, list) else list(value) if isinstance(value, dict) else [value]
+                for item in items:
+                    if isinstance(item, dict):
+                        item = item.get("name") or item.get("id")
+                    if isinstance(item, (str, int, float)) and not isinstance(item, bool):
+                        values.add(str(item).lower())
+        return values
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() - self.fetched_at > CATALOG_TTL_SECONDS
+
+    def search(self, filters: Dict[str, str], query: Optional[str] = None) -> List[int]:
+        candidates = None
+        for field, value in filters.items():
+            positions = set(self.indexes[field].get(value.lower(), ()))
+            candidates = positions if candidates is None else candidates & positions
+        for token in re.findall(r"[a-z0-9]+", (query or "").lower()):
+            positions = set(self.text_index.get(token, ()))
+            candidates = positions if candidates is None else candidates & positions
+        if candidates is None:
+            return list(range(len(self.entries)))
+        return sorted(candidates)
+
+
+def _monotonic_since(wall_time: float) -> float:
+    """Converts a wall-clock timestamp stored in the shared cache to this process's monotonic clock."""
+    return time.monotonic() - (time.time() - wall_time)
+
+
+_mockup_catalog: Optional[MockupCatalog] = None
+_mockup_catalog_lock = asyncio.Lock()
+
+
+async def _get_mockup_catalog(refresh: bool = False) -> MockupCatalog:
+    """Returns the cached mockup catalog, fetching and indexing it when missing or expired."""
+    global _mockup_catalog
+    if _mockup_catalog and not _mockup_catalog.expired and not refresh:
+        return _mockup_catalog
+    async with _mockup_catalog_lock:
+        if _mockup_catalog and not _mockup_catalog.expired and not refresh:
+            return _mockup_catalog
+        shared = None if refresh else await _cache.get("mockup-catalog")
+        if shared:
+            data, fetched_at = shared["data"], _monotonic_since(shared["fetched_at"])
+        else:
+            response = await _hedged_get("mockup-catalog", MOCKUP_CATALOG_URL, timeout=_upstream_timeout(30.0))
+            response.raise_for_status()
+            # orjson in a worker thread: several times faster than any pure-Python streaming parse
+            data = await _parse_json(response)
+            fetched_at = time.monotonic()
+            await _cache.set("mockup-catalog", {"data": data, "fetched_at": time.time()}, CATALOG_TTL_SECONDS)
+        # Indexing is pure Python, so a worker thread lets the loop keep switching
+        _mockup_catalog = await asyncio.to_thread(MockupCatalog, data, fetched_at)
+        return _mockup_catalog
+
+
+def _attribute_key(attributes: Dict[str, Any]) -> frozenset:
+    return frozenset((str(k).lower(), str(v).lower()) for k, v in attributes.items())
+
+
+class ProductSpec:
+    """A Prodigi product with its print areas indexed over every variant."""
+
+    def __init__(self, sku: str, product: Dict[str, Any], fetched_at: float):
+        self.sku = sku
+        self.product = product
+        self.fetched_at = fetched_at
+        self.variants = product.get("variants", [])
+        # Full attribute combination -> variant, for exact lookups
+        self.variant_index: Dict[frozenset, int] = {}
+        # Single attribute value -> variants, for partial lookups
+        self.attribute_index: Dict[tuple, set] = {}
+        self.attribute_options: Dict[str, set] = {}
+        for position, variant in enumerate(self.variants):
+            attributes = variant.get("attributes") or {}
+            self.variant_index.setdefault(_attribute_key(attributes), position)
+            for name, value in _attribute_key(attributes):
+                self.attribute_index.setdefault((name, value), set()).add(position)
+                self.attribute_options.setdefault(name, set()).add(value)
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() - self.fetched_at > PRODUCT_TTL_SECONDS
+
+    def print_area(self, position: int, print_area: str = "default") -> Optional[Dict[str, Any]]:
+        area = (self.variants[position].get("printAreaSizes") or {}).get(print_area)
+        if not area:
+            return None
+        return {"width": area.get("horizontalResolution"), "height": area.get("verticalResolution")}
+
+    def find_variants(self, attributes: Optional[Dict[str, Any]] = None) -> List[int]:
+        """Returns the variants matching every given attribute, case-insensitively.
+        
+        Raises ValueError for unknown attributes or values, and when no variant has them all.
+        """
+        if not attributes:
+            return list(range(len(self.variants)))
+        key = _attribute_key(attributes)
+        if key in self.variant_index:
+            return [self.variant_index[key]]
+        for name, value in key:
+            if name not in self.attribute_options:
+                raise ValueError(
+                    f"Unknown attribute '{name}'. Available: {', '.join(sorted(self.attribute_options)) or 'none'}"
+                )
+            if value not in self.attribute_options[name]:
+                raise ValueError(
+                    f"Unknown {name} '{value}'. Available: {', '.join(sorted(self.attribute_options[name]))}"
+                )
+        positions = sorted(set.intersection(*(self.attribute_index[pair] for pair in key)))
+        if not positions:
+            names = sorted(name for name, _ in key)
+            combinations = sorted({
+                ", ".join(f"{name}={dict(_attribute_key(variant.get('attributes') or {})).get(name)}" for name in names)
+                for variant in self.variants
+            })
+            raise ValueError(
+                f"No variant matches attributes {dict(sorted(key))}. "
+                f"Valid combinations: {'; '.join(combinations[:20])}{'; ...' if len(combinations) > 20 else ''}"
+            )
+        return positions
+
+    def print_area_options(self, positions: List[int], print_area: str = "default") -> List[Dict[str, Any]]:
+        """Groups variants by print area size, listing the attribute values behind each size."""
+        groups: Dict[tuple, Dict[str, set]] = {}
+        for position in positions:
+            area = self.print_area(position, print_area)
+            if not area:
+                continue
+            group = groups.setdefault((area["width"], area["height"]), {})
+            for name, value in (self.variants[position].get("attributes") or {}).items():
+                group.setdefault(name, set()).add(str(value))
+        return [
+            {
+                "pixel_dimensions": {"width": width, "height": height},
+                "attributes": {name: sorted(values) for name, values in attributes.items()},
+            }
+            for (width, height), attributes in groups.items()
+        ]
+
+
+# Least recently used first; evicted specs are rebuilt from the shared cache
+_product_specs: "OrderedDict[str, ProductSpec]" = OrderedDict()
+_product_spec_fetches: Dict[str, asyncio.Task] = {}
+_host_semaphores: Dict[str, "_HostSemaphore"] = {}
+
+
+class _HostSemaphore:
+    """Semaphore that counts its holders and waiters, so /readyz can report them."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_use = 0
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(limit)
+
+    async def __aenter__(self) -> "_HostSemaphore":
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.in_use += 1
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        self.in_use -= 1
+        self._semaphore.release()
+
+
+def _host_semaphore(url: str) -> _HostSemaphore:
+    """Caps concurrent requests to one upstream host."""
+    host = httpx.URL(url).host
+    if host not in _host_semaphores:
+        _host_semaphores[host] = _HostSemaphore(UPSTREAM_MAX_CONCURRENCY_PER_HOST)
+    return _host_semaphores[host]
+
+
+async def _fetch_product_spec(sku: str) -> ProductSpec:
+    key = f"product:{sku.upper()}"
+    shared = await _cache.get(key)
+    if shared:
+        spec = ProductSpec(sku, shared["product"], _monotonic_since(shared["fetched_at"]))
+    else:
+        url = f"{PRODIGI_BASE_URL}/products/{sku}"
+        async with _host_semaphore(url):
+            response = await _hedged_get(
+                "prodigi-product", url, headers={"X-API-Key": PRODIGI_API_KEY}, timeout=_upstream_timeout(30.0)
+            )
+        response.raise_for_status()
+        result = await _parse_json(response)
+        spec = ProductSpec(sku, result.get("product", {}), time.monotonic())
+        await _cache.set(key, {"product": spec.product, "fetched_at": time.time()}, PRODUCT_TTL_SECONDS)
+    _product_specs[sku.upper()] = spec
+    _product_specs.move_to_end(sku.upper())
+    while len(_product_specs) > PRODUCT_SPECS_MAX:
+        _product_specs.popitem(last=False)
+    return spec
+
+
+async def _get_product_spec(sku: str) -> ProductSpec:
+    """Returns the cached product spec for a SKU, fetching it from Prodigi when missing or expired.
+    
+    Concurrent requests for the same SKU share one fetch.
+    """
+    key = sku.upper()
+    spec = _product_specs.get(key)
+    if spec and not spec.expired:
+        _product_specs.move_to_end(key)
+        return spec
+    if key not in _product_spec_fetches:
+        task = _start_shared(_fetch_product_spec(sku))
+        task.add_done_callback(lambda _: _product_spec_fetches.pop(key, None))
+        _product_spec_fetches[key] = task
+    return await _join_shared(_product_spec_fetches[key])
+
+
+def _check_fetch_url(url: str) -> None:
+    """Raises ValueError unless the URL is https on one of FETCH_ALLOWED_HOSTS."""
+    parsed = httpx.URL(url)
+    host = parsed.host.lower()
+    if parsed.scheme != "https" or not any(
+        host.endswith(allowed[1:]) if allowed.startswith("*.") else host == allowed
+        for allowed in FETCH_ALLOWED_HOSTS
+    ):
+        raise ValueError(f"Only https URLs on {', '.join(FETCH_ALLOWED_HOSTS)} can be fetched")
+
+
+async def _read_blob_metadata(
+    client: httpx.AsyncClient,
+    url: str,
+    header_only: bool = True,
+    checksum_algorithm: str = "sha256",
+) -> Dict[str, Any]:
+    """Streams a blob and returns its size, checksum and format metadata without buffering it."""
+    async with client.stream("GET", url, timeout=_upstream_timeout(30.0)) as response:
+        if response.status_code != 200:
+            return {"error": f"Failed to fetch blob. Status: {response.status_code}"}
+        
+        content_type = response.headers.get("content-type", "")
+        content_md5 = response.headers.get("content-md5")
+        content_length = response.headers.get("content-length")
+        digest = None if header_only else hashlib.new(checksum_algorithm)
+        md5 = hashlib.md5() if content_md5 and not header_only else None
+        header = bytearray()
+        metadata = None
+        header_complete = False
+        pdf_scanner = None
+        size = 0
+        
+        async for chunk in response.aiter_bytes(STREAM_CHUNK_SIZE):
+            size += len(chunk)
+            if digest:
+                digest.update(chunk)
+            if md5:
+                md5.update(chunk)
+            
+            if pdf_scanner:
+                pdf_scanner.feed(chunk)
+            elif not header_complete:
+                header.extend(chunk[:HEADER_PROBE_BYTES - len(header)])
+                if header.startswith(b"%PDF-"):
+                    pdf_scanner = _PdfScanner()
+                    pdf_scanner.feed(chunk)
+                else:
+                    metadata, header_complete = _parse_image_header(bytes(header))
+                    header_complete = header_complete or len(header) >= HEADER_PROBE_BYTES
+            
+            if header_only and (header_complete or pdf_scanner):
+                break
+    
+    if pdf_scanner and header_only and not pdf_scanner.complete:
+        # Non-linearized PDFs keep the page tree near the end of the file
+        async with client.stream(
+            "GET",
+            url,
+            headers={"Range": f"bytes=-{PDF_TAIL_PROBE_BYTES}"},
+            timeout=_upstream_timeout(30.0),
+        ) as tail:
+            if tail.status_code == 206:
+                pdf_scanner.feed(await tail.aread())
+    if pdf_scanner:
+        metadata = pdf_scanner.metadata()
+    
+    result = {
+        "success": True,
+        "output_url": url,
+        "content_type": content_type,
+        "size_bytes": int(content_length) if header_only and content_length else size,
+        "header_only": header_only,
+        "metadata": metadata or {"format": "unknown"},
+        "checksum": None,
+    }
+    if digest:
+        result["checksum"] = {"algorithm": checksum_algorithm, "value": digest.hexdigest()}
+    if md5:
+        result["content_md5_matches"] = base64.b64encode(md5.digest()).decode() == content_md5
+    return result
+
+
+def _build_transform_params(
+    crop_pixels: Optional[List[int]] = None,
+    crop_mm: Optional[List[float]] = None,
+    crop_inches: Optional[List[float]] = None,
+    crop_box_pixels_offset: Optional[List[int]] = None,
+    crop_box_mm_offset: Optional[List[float]] = None,
+    crop_box_inches_offset: Optional[List[float]] = None,
+    crop_box_pixels: Optional[List[int]] = None,
+    crop_box_mm: Optional[List[float]] = None,
+    crop_box_inches: Optional[List[float]] = None,
+    crop_aspect_ratio: Optional[float] = None,
+    pad_pixels: Optional[List[int]] = None,
+    pad_mm: Optional[List[float]] = None,
+    pad_inches: Optional[List[float]] = None,
+    contain_pixels: Optional[List[int]] = None,
+    contain_mm: Optional[List[float]] = None,
+    contain_inches: Optional[List[float]] = None,
+    override_dpi: Optional[int] = None,
+    rotate: Optional[int] = None,
+    rotate_to: Optional[Literal["landscape", "portrait"]] = None,
+    overwrite_partial_transparency: Optional[int] = None,
+    transparency_to_color: Optional[List[int]] = None,
+    grayscale: Optional[bool] = None,
+    pdf: Optional[bool] = None,
+    multi_page: Optional[bool] = None,
+    same_pixel_size: Optional[bool] = None,
+    stickerise_pixels: Optional[int] = None,
+    stickerise_mm: Optional[float] = None,
+    stickerise_inches: Optional[float] = None,
+    expand_pixels: Optional[int] = None,
+    expand_mm: Optional[float] = None,
+    expand_inches: Optional[float] = None,
+    transforms_array: Optional[List[Dict]] = None,
+) -> ImageOpsTransformParamsIn:
+    """Converts the pixels/mm/inches tool arguments into ImageOpsTransformParamsIn."""
+    crop_units = None
+    if crop_pixels:
+        crop_units = [Unit(pixels=p) for p in crop_pixels]
+    elif crop_mm:
+        crop_units = [Unit(millimeter=p) for p in crop_mm]
+    elif crop_inches:
+        crop_units = [Unit(inches=p) for p in crop_inches]
+
+    crop_box_units = None
+    if crop_box_pixels:
+        crop_box_units = [[Unit(pixels=p) for p in crop_box_pixels]] if not crop_box_pixels_offset else [
+            [Unit(pixels=p) for p in crop_box_pixels],
+            [Unit(pixels=p) for p in crop_box_pixels_offset]
+        ]
+    elif crop_box_mm:
+        crop_box_units = [[Unit(millimeter=p) for p in crop_box_mm]] if not crop_box_mm_offset else [
+            [Unit(millimeter=p) for p in crop_box_mm],
+            [Unit(millimeter=p) for p in crop_box_mm_offset]
+        ]
+    elif crop_box_inches:
+        crop_box_units = [[Unit(inches=p) for p in crop_box_inches]] if not crop_box_inches_offset else [
+            [Unit(inches=p) for p in crop_box_inches],
+            [Unit(inches=p) for p in crop_box_inches_offset]
+        ]
+
+    pad_units = None
+    if pad_pixels:
+        pad_units = [Unit(pixels=p) for p in pad_pixels]
+    elif pad_mm:
+        pad_units = [Unit(millimeter=p) for p in pad_mm]
+    elif pad_inches:
+        pad_units = [Unit(inches=p) for p in pad_inches]
+
+    contain_units = None
+    if contain_pixels:
+        contain_units = [Unit(pixels=p) for p in contain_pixels]
+    elif contain_mm:
+        contain_units = [Unit(millimeter=p) for p in contain_mm]
+    elif contain_inches:
+        contain_units = [Unit(inches=p) for p in contain_inches]
+
+    stickerise_unit = None
+    if stickerise_pixels:
+        stickerise_unit = Unit(pixels=stickerise_pixels)
+    elif stickerise_mm:
+        stickerise_unit = Unit(millimeter=stickerise_mm)
+    elif stickerise_inches:
+        stickerise_unit = Unit(inches=stickerise_inches)
+
+    expand_unit = None
+    if expand_pixels:
+        expand_unit = Unit(pixels=expand_pixels)
+    elif expand_mm:
+        expand_unit = Unit(millimeter=expand_mm)
+    elif expand_inches:
+        expand_unit = Unit(inches=expand_inches)
+
+    return ImageOpsTransformParamsIn(
+        image_ops=True,
+        crop=crop_units,
+        crop_box=crop_box_units,
+        crop_aspect_ratio=crop_aspect_ratio,
+        pad=pad_units,
+        contain=contain_units,
+        override_dpi=override_dpi,
+        rotate=rotate,
+        rotate_to=rotate_to,
+        overwrite_partial_transparency=overwrite_partial_transparency,
+        transparency_to_color=transparency_to_color,
+        grayscale=grayscale,
+        pdf=pdf,
+        multi_page=multi_page,
+        same_pixel_size=same_pixel_size,
+        stickerise=stickerise_unit,
+        expand=expand_unit,
+        transforms_array=transforms_array,
+    )
+
+
+def _unit_arguments(
+    crop: Optional[UnitValues] = None,
+    crop_box: Optional[CropBoxIn] = None,
+    pad: Optional[UnitValues] = None,
+    contain: Optional[UnitValues] = None,
+    stickerise: Optional[UnitValue] = None,
+    expand: Optional[UnitValue] = None,
+) -> Dict[str, Any]:
+    """Maps the compact unit-tagged arguments onto the flat pixels/mm/inches arguments."""
+    def values(unit: str, raw: List[float]) -> List[Any]:
+        # Pixel arguments are integers; round rather than truncate fractional values
+        return [round(v) for v in raw] if unit == "pixels" else raw
+    
+    arguments = {}
+    for name, spec in (("crop", crop), ("pad", pad), ("contain", contain)):
+        if spec:
+            arguments[f"{name}_{spec.unit}"] = values(spec.unit, spec.values)
+    for name, spec in (("stickerise", stickerise), ("expand", expand)):
+        if spec:
+            arguments[f"{name}_{spec.unit}"] = values(spec.unit, [spec.value])[0]
+    if crop_box:
+        arguments[f"crop_box_{crop_box.unit}"] = values(crop_box.unit, crop_box.size)
+        if crop_box.offset:
+            arguments[f"crop_box_{crop_box.unit}_offset"] = values(crop_box.unit, crop_box.offset)
+    return arguments
+
+
+# Nested unit-tagged parameters of the compact manifest, each replacing a pixels/mm/inches family
+_UNIT_GROUPS = {
+    "crop": UnitValues,
+    "crop_box": CropBoxIn,
+    "pad": UnitValues,
+    "contain": UnitValues,
+    "stickerise": UnitValue,
+    "expand": UnitValue,
+}
+_UNIT_PARAM_RE = re.compile(r"(crop_box|crop|pad|contain|stickerise|expand)_(?:pixels|mm|inches)(?:_offset)?$")
+
+
+def _transform_parameters(compact: bool) -> List[inspect.Parameter]:
+    parameters: Dict[str, inspect.Parameter] = {}
+    for param in inspect.signature(_build_transform_params).parameters.values():
+        match = _UNIT_PARAM_RE.match(param.name) if compact else None
+        if match:
+            param = inspect.Parameter(
+                match.group(1), param.KEYWORD_ONLY, default=None, annotation=Optional[_UNIT_GROUPS[match.group(1)]]
+            )
+        parameters.setdefault(param.name, param.replace(kind=param.KEYWORD_ONLY))
+    return list(parameters.values())
+
+
+def _with_transform_params(fn=None, *, compact: bool = False):
+    """Declares the transform options of _build_transform_params on a tool that collects them as `**transform`.
+    
+    The options are listed once, in _build_transform_params, yet still appear as individual
+    fields in the tool's input schema. With `compact`, each pixels/mm/inches family is declared
+    as one nested unit-tagged parameter instead and mapped back before `fn` is called.
+    """
+    if fn is None:
+        return functools.partial(_with_transform_params, compact=compact)
+    own = [param for param in inspect.signature(fn).parameters.values() if param.kind is not param.VAR_KEYWORD]
+    transform = _transform_parameters(compact)
+    
+    @functools.wraps(fn)
+    async def tool(**kwargs):
+        if compact:
+            kwargs.update(_unit_arguments(**{name: kwargs.pop(name, None) for name in _UNIT_GROUPS}))
+        return await fn(**kwargs)
+    
+    tool.__signature__ = inspect.Signature(
+        [param.replace(kind=param.KEYWORD_ONLY) for param in own] + transform,
+        return_annotation=inspect.signature(fn).return_annotation,
+    )
+    tool.__annotations__ = {
+        **{param.name: param.annotation for param in transform},
+        **fn.__annotations__,
+    }
+    return tool
+
+
+def _unit_to_pixels(unit: Unit, dpi: Optional[float]) -> int:
+    if unit.pixels is not None:
+        return unit.pixels
+    if unit.inches is None and unit.millimeter is None:
+        raise ValueError("Unit has no pixels, inches or millimeter value")
+    if not dpi:
+        raise ValueError("Physical units (mm/inches) need a source DPI or override_dpi")
+    if unit.inches is not None:
+        return round(unit.inches * dpi)
+    return round(unit.millimeter / 25.4 * dpi)
+
+
+def _orientation(width: int, height: int) -> str:
+    if width == height:
+        return "square"
+    return "landscape" if width > height else "portrait"
+
+
+def _plan_geometry(
+    params: ImageOpsTransformParamsIn,
+    state: Dict[str, Any],
+    steps: List[Dict[str, Any]],
+    warnings: List[str],
+) -> None:
+    """Applies one ImageOpsTransformParamsIn to the planning state in upstream order.
+    
+    Operations run in field order. Physical units are converted at override_dpi
+    when set, otherwise at the current DPI. Raises ValueError on impossible geometry.
+    """
+    if params.override_dpi:
+        state["dpi"] = params.override_dpi
+    dpi = state["dpi"]
+    
+    def record(operation: str, detail: Optional[str] = None) -> None:
+        step = {"operation": operation, "width": state["width"], "height": state["height"]}
+        if detail:
+            step["detail"] = detail
+        steps.append(step)
+    
+    if params.crop:
+        borders = [_unit_to_pixels(u, dpi) for u in params.crop]
+        if len(borders) == 1:
+            top = right = bottom = left = borders[0]
+        elif len(borders) == 2:
+            top = bottom = borders[0]
+            right = left = borders[1]
+        elif len(borders) == 4:
+            top, right, bottom, left = borders
+        else:
+            raise ValueError("crop takes 1, 2 or 4 values [top, right, bottom, left]")
+        state["width"] -= left + right
+        state["height"] -= top + bottom
+        if state["width"] <= 0 or state["height"] <= 0:
+            raise ValueError("crop removes the whole image")
+        record("crop", f"top={top} right={right} bottom={bottom} left={left}")
+    
+    if params.crop_box:
+        box = [_unit_to_pixels(u, dpi) for u in params.crop_box[0]]
+        offset = [_unit_to_pixels(u, dpi) for u in params.crop_box[1]] if len(params.crop_box) > 1 else [0, 0]
+        if len(box) == 4:
+            offset = [box[0], box[1]]
+            box = [box[2] - box[0], box[3] - box[1]]
+        if len(box) != 2 or len(offset) != 2:
+            raise ValueError("crop_box takes [width, height] and an optional [x, y] offset")
+        if box[0] <= 0 or box[1] <= 0:
+            raise ValueError("crop_box must have a positive width and height")
+        if offset[0] + box[0] > state["width"] or offset[1] + box[1] > state["height"]:
+            raise ValueError(
+                f"crop_box {box[0]}x{box[1]} at offset {offset[0]},{offset[1]} exceeds the "
+                f"{state['width']}x{state['height']} image"
+            )
+        state["width"], state["height"] = box
+        record("crop_box", f"offset={offset[0]},{offset[1]}")
+    
+    if params.crop_aspect_ratio is not None:
+        ratio = params.crop_aspect_ratio
+        if ratio <= 0:
+            raise ValueError("crop_aspect_ratio must be positive")
+        if state["width"] / state["height"] > ratio:
+            state["width"] = round(state["height"] * ratio)
+        else:
+            state["height"] = round(state["width"] / ratio)
+        record("crop_aspect_ratio", f"ratio={ratio}")
+    
+    if params.pad:
+        target = [_unit_to_pixels(u, dpi) for u in params.pad]
+        if len(target) != 2:
+            raise ValueError("pad takes [width, height]")
+        if min(target) <= 0:
+            raise ValueError("pad must have a positive width and height")
+        if target[0] < state["width"] or target[1] < state["height"]:
+            warnings.append(
+                f"pad target {target[0]}x{target[1]} is smaller than the "
+                f"{state['width']}x{state['height']} image; it will be scaled down to fit"
+            )
+        state["width"], state["height"] = target
+        record("pad")
+    
+    if params.contain:
+        bounds = [_unit_to_pixels(u, dpi) for u in params.contain]
+        if len(bounds) != 2:
+            raise ValueError("contain takes [width, height]")
+        if min(bounds) <= 0:
+            raise ValueError("contain must have a positive width and height")
+        # Same rounding as PIL's ImageOps.contain
+        image_ratio = state["width"] / state["height"]
+        bounds_ratio = bounds[0] / bounds[1]
+        if image_ratio > bounds_ratio:
+            state["width"], state["height"] = bounds[0], round(state["height"] / state["width"] * bounds[0])
+        elif image_ratio < bounds_ratio:
+            state["width"], state["height"] = round(state["width"] / state["height"] * bounds[1]), bounds[1]
+        else:
+            state["width"], state["height"] = bounds
+        record("contain", f"within {bounds[0]}x{bounds[1]}")
+    
+    if params.override_dpi:
+        record("override_dpi", f"dpi={params.override_dpi}")
+    
+    if params.rotate:
+        angle = params.rotate % 360
+        if angle in (90, 270):
+            state["width"], state["height"] = state["height"], state["width"]
+        elif angle not in (0, 180):
+            radians = math.radians(angle)
+            width, height = state["width"], state["height"]
+            state["width"] = round(abs(width * math.cos(radians)) + abs(height * math.sin(radians)))
+            state["height"] = round(abs(width * math.sin(radians)) + abs(height * math.cos(radians)))
+            warnings.append(f"rotate {angle} is not a multiple of 90; canvas assumed to expand to fit")
+        record("rotate", f"angle={angle}")
+    
+    if params.rotate_to:
+        if params.rotate_to not in ("landscape", "portrait"):
+            raise ValueError("rotate_to must be 'landscape' or 'portrait'")
+        if _orientation(state["width"], state["height"]) not in (params.rotate_to, "square"):
+            state["width"], state["height"] = state["height"], state["width"]
+        record("rotate_to", params.rotate_to)
+    
+    if params.overwrite_partial_transparency is not None:
+        if not 0 <= params.overwrite_partial_transparency <= 255:
+            raise ValueError("overwrite_partial_transparency must be between 0 and 255")
+        record("overwrite_partial_transparency")
+    
+    if params.transparency_to_color is not None:
+        color = params.transparency_to_color
+        if len(color) != 3 or any(not 0 <= c <= 255 for c in color):
+            raise ValueError("transparency_to_color takes [r, g, b] with values 0-255")
+        record("transparency_to_color")
+    
+    if params.grayscale:
+        record("grayscale")
+    
+    if params.stickerise:
+        border = _unit_to_pixels(params.stickerise, dpi)
+        expand = _unit_to_pixels(params.expand, dpi) if params.expand else 0
+        if expand <= border:
+            warnings.append(
+                f"stickerise border of {border}px may overflow the canvas; set expand larger than stickerise"
+            )
+        record("stickerise", f"border={border}")
+    
+    if params.expand:
+        border = _unit_to_pixels(params.expand, dpi)
+        state["width"] += 2 * border
+        state["height"] += 2 * border
+        record("expand", f"border={border}")
+    
+    if params.pdf:
+        record("pdf", "multi_page" if params.multi_page else None)
+    
+    for entry in params.transforms_array or []:
+        _plan_geometry(ImageOpsTransformParamsIn(**entry), state, steps, warnings)
+
+
+def _plan_transform(
+    params: ImageOpsTransformParamsIn,
+    width: int,
+    height: int,
+    dpi: Optional[float] = None,
+) -> Dict[str, Any]:
+    """Computes the output canvas of a transform locally, without calling the API."""
+    state = {"width": width, "height": height, "dpi": dpi}
+    steps = []
+    warnings = []
+    errors = []
+    try:
+        _plan_geometry(params, state, steps, warnings)
+    except ValueError as e:
+        errors.append(str(e))
+    
+    result = {
+        "width": state["width"],
+        "height": state["height"],
+        "orientation": _orientation(state["width"], state["height"]),
+        "dpi": state["dpi"],
+    }
+    if state["dpi"]:
+        result["physical_size_inches"] = [
+            round(state["width"] / state["dpi"], 3),
+            round(state["height"] / state["dpi"], 3),
+        ]
+        result["physical_size_mm"] = [
+            round(state["width"] / state["dpi"] * 25.4, 1),
+            round(state["height"] / state["dpi"] * 25.4, 1),
+        ]
+    return {
+        "valid": not errors,
+        "source": {"width": width, "height": height, "dpi": dpi},
+        "steps": steps,
+        "result": result,
+        "warnings": warnings,
+        "errors": errors,
+    }
+
+
+async def _plan_for_source(
+    transform_params: ImageOpsTransformParamsIn,
+    source_image_url: Optional[str] = None,
+    source_width: Optional[int] = None,
+    source_height: Optional[int] = None,
+    source_dpi: Optional[float] = None,
+) -> Dict[str, Any]:
+    """Plans a transform, reading the source header for any dimensions not given."""
+    if not (source_width and source_height):
+        if not source_image_url:
+            return {"error": "Provide source_width and source_height, or a source_image_url to read them from"}
+        async with _upstream_client() as client:
+            probe = await _read_blob_metadata(client, source_image_url, header_only=True)
+        if "error" in probe:
+            return probe
+        metadata = probe["metadata"]
+        if not (metadata.get("width") and metadata.get("height")):
+            return {
+                "error": f"Could not read pixel dimensions from a {metadata.get('format')} source",
+                "details": "Pass source_width, source_height and source_dpi explicitly",
+            }
+        source_width, source_height = metadata["width"], metadata["height"]
+        if source_dpi is None and metadata.get("dpi"):
+            source_dpi = metadata["dpi"][0]
+    
+    return {"success": True, **_plan_transform(transform_params, source_width, source_height, source_dpi)}
+
+
+_PER_PIXEL_OPS = {"grayscale", "transparency_to_color", "overwrite_partial_transparency"}
+_CROP_OPS = {"crop", "crop_box", "crop_aspect_ratio"}
+
+
+def _op_keys(ops: Dict[str, Any]) -> set:
+    return set(ops) - {"image_ops"}
+
+
+def _unit_kind(*unit_lists: List[Dict[str, Any]]) -> Optional[str]:
+    kinds = {key for units in unit_lists for unit in units for key in unit}
+    return kinds.pop() if len(kinds) == 1 else None
+
+
+def _crop_borders(units: List[Dict[str, Any]]) -> Optional[List[Dict[str, Any]]]:
+    if len(units) == 1:
+        return units * 4
+    if len(units) == 2:
+        return [units[0], units[1], units[0], units[1]]
+    if len(units) == 4:
+        return units
+    return None
+
+
+def _drop_noops(ops: Dict[str, Any], changes: List[str], where: str = "") -> Dict[str, Any]:
+    ops = dict(ops)
+    if "rotate" in ops:
+        angle = ops["rotate"] % 360
+        if angle == 0:
+            changes.append(f"{where}dropped rotate {ops.pop('rotate')} (no-op)")
+        elif angle != ops["rotate"]:
+            changes.append(f"{where}normalized rotate {ops['rotate']} to {angle}")
+            ops["rotate"] = angle
+    if "crop" in ops and not any(v for unit in ops["crop"] for v in unit.values()):
+        ops.pop("crop")
+        changes.append(f"{where}dropped zero crop")
+    if len(ops.get("crop_box") or []) > 1 and not any(v for unit in ops["crop_box"][1] for v in unit.values()):
+        ops["crop_box"] = ops["crop_box"][:1]
+        changes.append(f"{where}dropped zero crop_box offset")
+    for key in ("stickerise", "expand"):
+        if key in ops and not any(ops[key].values()):
+            ops.pop(key)
+            changes.append(f"{where}dropped zero {key}")
+    for key in ("grayscale", "pdf"):
+        if ops.get(key) is False:
+            ops.pop(key)
+            changes.append(f"{where}dropped {key}: false")
+    if "pad" in ops and ops.get("contain") == ops["pad"]:
+        # pad already resizes into exactly these bounds
+        ops.pop("contain")
+        changes.append(f"{where}dropped contain matching pad")
+    return ops
+
+
+def _optimize_transform(params: ImageOpsTransformParamsIn):
+    """Removes redundant and cancelling steps from a transform before it is submitted.
+    
+    Returns the optimized parameters and a list describing each change.
+    """
+    changes = []
+    ops = _drop_noops(params.model_dump(exclude_none=True), changes)
+    chain = ops.pop("transforms_array", None)
+    if not chain:
+        return ImageOpsTransformParamsIn(**ops), changes
+    
+    optimized = []
+    for index, entry in enumerate(chain):
+        where = f"transforms_array[{index}]: "
+        entry = _drop_noops(entry, changes, where)
+        keys = _op_keys(entry)
+        if not keys:
+            changes.append(f"{where}dropped empty step")
+            continue
+        previous = optimized[-1] if optimized else {}
+        previous_keys = _op_keys(previous)
+        if keys == previous_keys == {"grayscale"}:
+            # Only back to back: a step in between (e.g. transparency_to_color) may add colour again
+            changes.append(f"{where}dropped repeated grayscale")
+            continue
+        if keys == previous_keys == {"rotate"} and previous["rotate"] % 90 == entry["rotate"] % 90 == 0:
+            # Other angles grow the canvas to fit, so they don't add up
+            angle = (previous["rotate"] + entry["rotate"]) % 360
+            changes.append(f"{where}folded rotate {previous['rotate']} + {entry['rotate']} into {angle}")
+            if angle:
+                previous["rotate"] = angle
+            else:
+                optimized.pop()
+            continue
+        if keys == previous_keys == {"crop"} and _unit_kind(previous["crop"], entry["crop"]):
+            kind = _unit_kind(previous["crop"], entry["crop"])
+            first, second = _crop_borders(previous["crop"]), _crop_borders(entry["crop"])
+            if first and second:
+                previous["crop"] = [{kind: a[kind] + b[kind]} for a, b in zip(first, second)]
+                changes.append(f"{where}merged consecutive crops")
+                continue
+        if (
+            keys == previous_keys == {"crop_box"}
+            and _unit_kind(*previous["crop_box"], *entry["crop_box"])
+            and all(len(units) == 2 for units in previous["crop_box"] + entry["crop_box"])
+        ):
+            kind = _unit_kind(*previous["crop_box"], *entry["crop_box"])
+            zero = [{kind: 0}, {kind: 0}]
+            first_offset = previous["crop_box"][1] if len(previous["crop_box"]) > 1 else zero
+            second_offset = entry["crop_box"][1] if len(entry["crop_box"]) > 1 else zero
+            first_size, second_size = previous["crop_box"][0], entry["crop_box"][0]
+            # Only a box inside the first one is the same crop; anything else is left for the planner to reject
+            if all(o[kind] + size[kind] <= bound[kind] for o, size, bound in zip(second_offset, second_size, first_size)):
+                offset = [{kind: a[kind] + b[kind]} for a, b in zip(first_offset, second_offset)]
+                previous["crop_box"] = [second_size, offset]
+                changes.append(f"{where}merged consecutive crop_box steps")
+                continue
+        optimized.append(entry)
+    
+    # Crops commute exactly with per-pixel operations, so run them first on fewer pixels
+    moved = True
+    while moved:
+        moved = False
+        for i in range(1, len(optimized)):
+            keys, previous_keys = _op_keys(optimized[i]), _op_keys(optimized[i - 1])
+            if keys <= _CROP_OPS and previous_keys <= _PER_PIXEL_OPS:
+                optimized[i - 1], optimized[i] = optimized[i], optimized[i - 1]
+                changes.append(f"moved {', '.join(sorted(keys))} ahead of {', '.join(sorted(previous_keys))}")
+                moved = True
+    
+    if optimized:
+        ops["transforms_array"] = optimized
+    return ImageOpsTransformParamsIn(**ops), changes
+
+
+# Named transforms mirroring the prompts below. Each preset maps its parameters
+# onto the async_image_transformation arguments. Parameters listed under "required"
+# have no sensible default and must be passed as positive overrides.
+TRANSFORM_PRESETS: Dict[str, Dict[str, Any]] = {
+    "crop_box": {
+        "description": "Crop a width x height region at an offset",
+        "required": ["width", "height"],
+        "defaults": {"offset_x": 100, "offset_y": 100},
+        "build": lambda p: {
+            "crop_box_pixels": [p["width"], p["height"]],
+            "crop_box_pixels_offset": [p["offset_x"], p["offset_y"]],
+        },
+    },
+    "crop_aspect_ratio": {
+        "description": "Crop to a width/height aspect ratio",
+        "defaults": {"aspect_ratio": 1.0},
+        "build": lambda p: {"crop_aspect_ratio": p["aspect_ratio"]},
+    },
+    "contain": {
+        "description": "Scale to fit within width x height pixels",
+        "defaults": {"width": 800, "height": 600},
+        "build": lambda p: {"contain_pixels": [p["width"], p["height"]]},
+    },
+    "rotate": {
+        "description": "Rotate by an angle in degrees",
+        "defaults": {"angle": 90},
+        "build": lambda p: {"rotate": p["angle"]},
+    },
+    "grayscale": {
+        "description": "Convert to grayscale",
+        "defaults": {},
+        "build": lambda p: {"grayscale": True},
+    },
+    "set_dpi": {
+        "description": "Set the DPI metadata",
+        "defaults": {"dpi": 300},
+        "build": lambda p: {"override_dpi": p["dpi"]},
+    },
+    "pad": {
+        "description": "Pad the canvas to width x height pixels",
+        "defaults": {"width": 1000, "height": 800},
+        "build": lambda p: {"pad_pixels": [p["width"], p["height"]]},
+    },
+    "stickerise": {
+        "description": "White sticker border in inches, with the canvas expanded 20% more",
+        "defaults": {"border_size": 20},
+        "build": lambda p: {
+            "stickerise_inches": p["border_size"],
+            "expand_inches": p["border_size"] + (p["border_size"] * 20 / 100),
+        },
+    },
+    "expand_border": {
+        "description": "Add a uniform border in pixels",
+        "defaults": {"border_size": 10},
+        "build": lambda p: {"expand_pixels": p["border_size"]},
+    },
+    "transparency_to_white": {
+        "description": "Replace transparency with white",
+        "defaults": {},
+        "build": lambda p: {"transparency_to_color": [255, 255, 255]},
+    },
+    "transparency_to_black": {
+        "description": "Replace transparency with black",
+        "defaults": {},
+        "build": lambda p: {"transparency_to_color": [0, 0, 0]},
+    },
+    "transparency_to_custom_color": {
+        "description": "Replace transparency with an RGB color",
+        "defaults": {"red": 128, "green": 128, "blue": 128},
+        "build": lambda p: {"transparency_to_color": [p["red"], p["green"], p["blue"]]},
+    },
+    "clean_transparency": {
+        "description": "Set semi-transparent pixels to an alpha value",
+        "defaults": {"alpha_value": 255},
+        "build": lambda p: {"overwrite_partial_transparency": p["alpha_value"]},
+    },
+    "sticker_with_padding": {
+        "description": "White sticker border plus padding, both in pixels",
+        "defaults": {"sticker_border": 20, "padding": 15},
+        "build": lambda p: {"stickerise_pixels": p["sticker_border"], "expand_pixels": p["padding"]},
+    },
+    "sticker_design": {
+        "description": "White sticker border in mm with half as much canvas expansion",
+        "defaults": {"size_mm": 10.0},
+        "build": lambda p: {"stickerise_mm": p["size_mm"], "expand_mm": p["size_mm"] * 0.5},
+    },
+    "pdf_multipage": {
+        "description": "Process every page of a multi-page PDF",
+        "defaults": {},
+        "build": lambda p: {"pdf": True, "multi_page": True, "same_pixel_size": True},
+    },
+    "print_ready": {
+        "description": "White background, DPI metadata and PDF output for print",
+        "defaults": {"dpi": 300},
+        "build": lambda p: {
+            "transparency_to_color": [255, 255, 255],
+            "override_dpi": p["dpi"],
+            "pdf": True,
+            "same_pixel_size": True,
+        },
+    },
+}
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_preset(name: str, overrides_json: str = "{}") -> bytes:
+    """Builds, validates and optimizes a preset once per set of overrides.
+    
+    Returns the serialized transform so request bodies can be assembled without
+    re-running pydantic for every source URL.
+    """
+    preset = TRANSFORM_PRESETS[name]
+    overrides = _json_loads(overrides_json)
+    required = preset.get("required", [])
+    allowed = [*required, *preset["defaults"]]
+    unknown = set(overrides) - set(allowed)
+    if unknown:
+        raise ValueError(
+            f"Unknown overrides for preset {name}: {', '.join(sorted(unknown))}. "
+            f"Allowed: {', '.join(allowed) or 'none'}"
+        )
+    for parameter in required:
+        value = overrides.get(parameter)
+        if not isinstance(value, (int, float)) or isinstance(value, bool) or value <= 0:
+            raise ValueError(f"Preset {name} requires a positive {parameter} override")
+    transform_params = _build_transform_params(**preset["build"]({**preset["defaults"], **overrides}))
+    transform_params, _ = _optimize_transform(transform_params)
+    return _json_dumps(transform_params.model_dump(exclude_none=True))
+
+
+# Fail at import rather than at request time if a preset template is invalid
+for _preset_name, _preset in TRANSFORM_PRESETS.items():
+    _compile_preset(_preset_name, json.dumps({parameter: 1 for parameter in _preset.get("required", [])}))
+
+# Identical transform submissions in flight on this instance; queued jobs live in the shared cache
+_transform_submissions: Dict[str, asyncio.Task] = {}
+# How long an instance may hold the lock for submitting a job before others submit it themselves
+TRANSFORM_LOCK_SECONDS = 30.0
+
+
+def _canonical_hash(value: Any) -> str:
+    return hashlib.sha256(json.dumps(value, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+
+async def _source_version(url: str) -> Optional[str]:
+    """Returns the source's ETag or Content-MD5, or None when its content can't be pinned down."""
+    try:
+        response = await _http_client().head(url, timeout=_upstream_timeout(10.0))
+    except httpx.HTTPError:
+        return None
+    if response.status_code != 200:
+        return None
+    return response.headers.get("etag") or response.headers.get("content-md5")
+
+
+def _sas_expires_soon(url: str) -> bool:
+    expiry = httpx.URL(url).params.get("se")
+    if not expiry:
+        return False
+    try:
+        expires_at = datetime.fromisoformat(expiry.replace("Z", "+00:00"))
+    except ValueError:
+        return False
+    return expires_at.timestamp() - time.time() < RESULT_MIN_VALIDITY_SECONDS
+
+
+async def _transform_job_status(output_url: str) -> str:
+    """Returns "completed", "queued" or "failed" for a transform job from its output blob.
+    
+    The API has no job status endpoint: a job is done once its output blob exists, and has
+    failed if the blob answers with anything but 404 (e.g. a revoked or read-only SAS).
+    """
+    try:
+        response = await _http_client().head(output_url, timeout=_upstream_timeout(10.0))
+    except httpx.TransportError:
+        return "queued"
+    if response.status_code == 200:
+        return "completed"
+    return "queued" if response.status_code == 404 else "failed"
+
+
+async def _cached_transform_status(entry: Dict[str, Any]) -> Optional[str]:
+    """Returns "completed" or "queued" for a cached job that can be reused, None otherwise."""
+    age = time.time() - entry["created_at"]
+    output_url = entry["result"]["output_url"]
+    if age > RESULT_CACHE_TTL_SECONDS or _sas_expires_soon(output_url):
+        return None
+    status = await _transform_job_status(output_url)
+    if status == "failed":
+        return None
+    # No output yet: still running, unless it has been long enough that the job likely failed
+    return status if status == "completed" or age < RESULT_JOB_GRACE_SECONDS else None
+
+
+async def _deduplicated_transform(request_body: Dict[str, Any], submit, reuse_existing: bool = True) -> Dict[str, Any]:
+    """Queues a transform job through `submit()` unless an identical one is queued or done.
+    
+    Jobs are keyed by the request less client_transform_id, and record the source's ETag or
+    Content-MD5 when queued. A job is reused only while the source still matches, so a changed
+    source is never served a stale result; the source is only probed when a job could be reused
+    or is being recorded. Concurrent identical submissions share one upstream call, across
+    instances when the cache is shared. With `reuse_existing=False` the job is always submitted
+    and replaces any cached one. Results carry the caller's client_transform_id and a
+    `cache_hit` flag.
+    """
+    source_image_url = request_body["source_image_url"]
+    fields = {name: value for name, value in request_body.items() if name != "client_transform_id"}
+    key = _canonical_hash(fields)
+    
+    def for_caller(result: Dict[str, Any]) -> Dict[str, Any]:
+        if "client_transform_id" in result and request_body.get("client_transform_id"):
+            return {**result, "client_transform_id": request_body["client_transform_id"]}
+        return result
+    
+    async def record(result: Dict[str, Any], version: Optional[str]) -> None:
+        # Only jobs with an output blob to check can be told apart from failed ones later
+        if "error" not in result and result.get("output_url") and version is not None:
+            await _cache.set(
+                f"transform:{key}",
+                {"result": result, "created_at": time.time(), "source_version": version},
+                RESULT_CACHE_TTL_SECONDS,
+            )
+    
+    if not reuse_existing:
+        await _cache.delete(f"transform:{key}")
+        result, version = await asyncio.gather(submit(), _source_version(source_image_url))
+        await record(result, version)
+        return {**result, "cache_hit": False}
+    
+    entry = await _cache.get(f"transform:{key}")
+    if entry:
+        version, status = await asyncio.gather(
+            _source_version(source_image_url), _cached_transform_status(entry)
+        )
+        if status and version == entry["source_version"]:
+            return {**for_caller(entry["result"]), "status": status, "cache_hit": True}
+        # The source changed or the job failed: forget it so nobody else reuses it
+        await _cache.delete(f"transform:{key}")
+    
+    async def submit_once() -> Tuple[Dict[str, Any], bool]:
+        lock = f"transform-lock:{key}"
+        claimed = await _cache.set_if_absent(lock, True, TRANSFORM_LOCK_SECONDS)
+        if not claimed:
+            # Another instance is submitting this job right now; wait for its result
+            give_up_at = time.monotonic() + TRANSFORM_LOCK_SECONDS
+            while time.monotonic() < give_up_at:
+                await asyncio.sleep(0.1)
+                entry = await _cache.get(f"transform:{key}")
+                if entry:
+                    return entry["result"], True
+                if await _cache.get(lock) is None:
+                    break
+        try:
+            # Pin the source version alongside the submission rather than ahead of it
+            result, version = await asyncio.gather(submit(), _source_version(source_image_url))
+            await record(result, version)
+            return result, False
+        finally:
+            if claimed:
+                await _cache.delete(lock)
+    
+    joined = key in _transform_submissions
+    if not joined:
+        task = _start_shared(submit_once())
+        task.add_done_callback(lambda _: _transform_submissions.pop(key, None))
+        _transform_submissions[key] = task
+    result, shared = await _join_shared(_transform_submissions[key])
+    return {**for_caller(result), "cache_hit": joined or shared}
+
+
+async def _put_blob(sas_url: str, data: bytes, content_type: str) -> None:
+    response = await _http_client().put(
+        sas_url,
+        content=data,
+        headers={"x-ms-blob-type": "BlockBlob", "Content-Type": content_type},
+        timeout=_upstream_timeout(60.0),
+    )
+    response.raise_for_status()
+
+
+async def _upload_stream_to_blob(
+    chunks: AsyncIterator[bytes],
+    sas_url: str,
+    content_type: str,
+) -> Dict[str, Any]:
+    """Streams a body into an Azure block blob through its SAS URL.
+    
+    Bodies that fit in one block go up with a single Put Blob. Larger ones are sent as
+    Put Block calls, uploading one block while the next is read, then committed with
+    Put Block List, so at most two blocks are held in memory.
+    """
+    client = _http_client()
+    block_ids: List[str] = []
+    buffer = bytearray()
+    size = 0
+    upload: Optional[asyncio.Future] = None
+    
+    async def put_block(block_id: str, data: bytes) -> None:
+        result = await client.put(
+            httpx.URL(sas_url).copy_merge_params({"comp": "block", "blockid": block_id}),
+            content=data,
+            timeout=_upstream_timeout(60.0),
+        )
+        result.raise_for_status()
+    
+    try:
+        async for chunk in chunks:
+            buffer.extend(chunk)
+            size += len(chunk)
+            if len(buffer) >= SYNC_BLOCK_SIZE:
+                if upload:
+                    await upload
+                # Block ids must all have the same length
+                block_ids.append(base64.b64encode(f"{len(block_ids):08d}".encode()).decode())
+                upload = asyncio.ensure_future(put_block(block_ids[-1], bytes(buffer)))
+                buffer = bytearray()
+        
+        if not block_ids:
+            await _put_blob(sas_url, bytes(buffer), content_type)
+            return {"size_bytes": size, "blocks": 1}
+        
+        await upload
+        if buffer:
+            block_ids.append(base64.b64encode(f"{len(block_ids):08d}".encode()).decode())
+            await put_block(block_ids[-1], bytes(buffer))
+        block_list = "".join(f"<Latest>{block_id}</Latest>" for block_id in block_ids)
+        result = await client.put(
+            httpx.URL(sas_url).copy_merge_params({"comp": "blocklist"}),
+            content=f'<?xml version="1.0" encoding="utf-8"?><BlockList>{block_list}</BlockList>',
+            headers={"x-ms-blob-content-type": content_type, "Content-Type": "application/xml"},
+            timeout=_upstream_timeout(30.0),
+        )
+        result.raise_for_status()
+        return {"size_bytes": size, "blocks": len(block_ids)}
+    except BaseException:
+        if upload and not upload.done():
+            upload.cancel()
+        raise
+
+
+def _blob_extension(content_type: str) -> Optional[str]:
+    for extension, marker in (("png", "png"), ("jpg", "jpeg"), ("jpg", "jpg"), ("pdf", "pdf")):
+        if marker in content_type:
+            return extension
+    return None
+
+
+def _write_pdf_pages(reader: "pypdf.PdfReader", start: int, stop: int) -> bytes:
+    writer = pypdf.PdfWriter()
+    for page in reader.pages[start:stop]:
+        writer.add_page(page)
+    output = io.BytesIO()
+    writer.write(output)
+    return output.getvalue()
+
+
+def _merge_pdf_chunks(chunks: List[Any], same_pixel_size: bool) -> tempfile.SpooledTemporaryFile:
+    """Concatenates chunk PDFs in order; with same_pixel_size, pages are scaled to the first page's size."""
+    writer = pypdf.PdfWriter()
+    for chunk in chunks:
+        for page in pypdf.PdfReader(chunk).pages:
+            writer.add_page(page)
+    if same_pixel_size and writer.pages:
+        # Each chunk was normalised on its own, so chunks may disagree on the common size
+        width, height = writer.pages[0].mediabox.width, writer.pages[0].mediabox.height
+        for page in writer.pages[1:]:
+            if (page.mediabox.width, page.mediabox.height) != (width, height):
+                page.scale_to(width, height)
+    output = tempfile.SpooledTemporaryFile(max_size=PDF_SPOOL_MAX_BYTES)
+    writer.write(output)
+    output.seek(0)
+    return output
+
+
+async def _download_to_spool(url: str, max_bytes: Optional[int] = None) -> tempfile.SpooledTemporaryFile:
+    """Downloads a blob into a spooled temp file; raises ValueError once it exceeds max_bytes."""
+    spool = tempfile.SpooledTemporaryFile(max_size=PDF_SPOOL_MAX_BYTES)
+    too_large = ValueError(f"The file is larger than the {max_bytes} byte limit")
+    try:
+        async with _http_client().stream("GET", url, timeout=_upstream_timeout(60.0)) as response:
+            response.raise_for_status()
+            if max_bytes is not None and int(response.headers.get("content-length") or 0) > max_bytes:
+                raise too_large
+            size = 0
+            async for chunk in response.aiter_bytes(STREAM_CHUNK_SIZE):
+                size += len(chunk)
+                if max_bytes is not None and size > max_bytes:
+                    raise too_large
+                await asyncio.to_thread(spool.write, chunk)
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
+
+
+async def _iter_spool(spool) -> AsyncIterator[bytes]:
+    while chunk := await asyncio.to_thread(spool.read, SYNC_BLOCK_SIZE):
+        yield chunk
 
-class MockupRequest(BaseModel):
-    source_image_url: Optional[str] = Field(None, description="User image to apply to product")
-    output_image_url: str = Field(description="URL where mockup will be delivered")
-    parameters: MockupParameters = Field(description="Mockup generation parameters")
 
-# @mcp.tool(
-#     title="Image Transformer (Sync) - Use async_image_transformation by default!",
-#     description="""Transform an image using Porcus Lardum ImageOps transformations (synchronous).
-    
-#     Parameters:
-#     - source_image_url: URL of the image to transform
-#     - crop_pixels: Remove pixels from borders [top, right, bottom, left] or single value for all
-#     - crop_mm: Remove millimeters from borders [top, right, bottom, left] or single value for all
-#     - crop_inches: Remove inches from borders [top, right, bottom, left] or single value for all
-#     - crop_box_pixels: Extract rectangle [x1, y1, x2, y2] in pixels
-#     - crop_box_mm: Extract rectangle [x1, y1, x2, y2] in millimeters
-#     - crop_box_inches: Extract rectangle [x1, y1, x2, y2] in inches
-#     - crop_aspect_ratio: Crop to width/height ratio (e.g., 1.77 for 16:9)
-#     - pad_pixels: Expand canvas [width, height] in pixels.
-#     - pad_mm: Expand canvas [width, height] in millimeters
-#     - pad_inches: Expand canvas [width, height] in inches
-#     - contain_pixels: Scale to fit within [width, height] in pixels
-#     - contain_mm: Scale to fit within [width, height] in millimeters
-#     - contain_inches: Scale to fit within [width, height] in inches
-#     - override_dpi: Set DPI metadata
-#     - rotate: Rotation angle in degrees
-#     - rotate_to: Auto-rotate to 'landscape' or 'portrait'
-#     - overwrite_partial_transparency: Replace semi-transparent pixels with 
-#       alpha value (0-255)
-#     - transparency_to_color: Replace transparency with RGB color [r,g,b] 
-#       (0-255 each)
-#     - grayscale: Convert to grayscale
-#     - pdf: Convert output to PDF
-#     - multi_page: Process multi-page PDFs by applying transforms to each page
-#     - same_pixel_size: Maintain pixel size in PDF output (default: true)
-#     - stickerise_pixels: Add white border for sticker or stickerise effect in pixels. If necessary, use the expand_pixels parameter to make sure the image new border doesn't overflow the canvas.
-#     - stickerise_mm: Add white border for sticker or stickerise effect in millimeters. If necessary, use the expand_mm parameter to make sure the image new border doesn't overflow the canvas.
-#     - stickerise_inches: Add white border for sticker or stickerise effect in inches. If necessary, use the expand_inches parameter to make sure the image new border doesn't overflow the canvas.
-#     - expand_pixels: Add uniform border by expanding canvas in pixels. 
-#       Useful for padding sticker images.
-#     - expand_mm: Add uniform border by expanding canvas in millimeters. 
-#       Useful for padding sticker images.
-#     - expand_inches: Add uniform border by expanding canvas in inches. 
-#       Useful for padding sticker images.
-
-#     Returns the transformed source image URL and metadata."""
-# )
-# async def transform_image(
-#     source_image_url: str,
-#     crop_pixels: Optional[List[int]] = None,
-#     crop_mm: Optional[List[float]] = None,
-#     crop_inches: Optional[List[float]] = None,
-#     crop_box_pixels: Optional[List[int]] = None,
-#     crop_box_mm: Optional[List[float]] = None,
-#     crop_box_inches: Optional[List[float]] = None,
-#     crop_aspect_ratio: Optional[float] = None,
-#     pad_pixels: Optional[List[int]] = None,
-#     pad_mm: Optional[List[float]] = None,
-#     pad_inches: Optional[List[float]] = None,
-#     contain_pixels: Optional[List[int]] = None,
-#     contain_mm: Optional[List[float]] = None,
-#     contain_inches: Optional[List[float]] = None,
-#     override_dpi: Optional[int] = None,
-#     rotate: Optional[int] = None,
-#     rotate_to: Optional[str] = None,
-#     overwrite_partial_transparency: Optional[int] = None,
-#     transparency_to_color: Optional[List[int]] = None,
-#     grayscale: Optional[bool] = None,
-#     pdf: Optional[bool] = None,
-#     multi_page: Optional[bool] = None,
-#     same_pixel_size: Optional[bool] = None,
-#     stickerise_pixels: Optional[int] = None,
-#     stickerise_mm: Optional[float] = None,
-#     stickerise_inches: Optional[float] = None,
-#     expand_pixels: Optional[int] = None,
-#     expand_mm: Optional[float] = None,
-#     expand_inches: Optional[float] = None,
-# ) -> Dict[str, Any]:
-    
-#     if not API_KEY:
-#         return {"error": "API key not configured. Please set PORCUS_LARDUM_API_KEY environment variable."}
-    
-#     try:
-#         # Convert values to Unit objects
-#         crop_units = None
-#         if crop_pixels:
-#             crop_units = [Unit(pixels=p) for p in crop_pixels]
-#         elif crop_mm:
-#             crop_units = [Unit(millimeter=p) for p in crop_mm]
-#         elif crop_inches:
-#             crop_units = [Unit(inches=p) for p in crop_inches]
-
-#         crop_box_units = None
-#         if crop_box_pixels:
-#             crop_box_units = [[Unit(pixels=p)] for p in crop_box_pixels]
-#         elif crop_box_mm:
-#             crop_box_units = [[Unit(millimeter=p)] for p in crop_box_mm]
-#         elif crop_box_inches:
-#             crop_box_units = [[Unit(inches=p)] for p in crop_box_inches]
-
-#         pad_units = None
-#         if pad_pixels:
-#             pad_units = [Unit(pixels=p) for p in pad_pixels]
-#         elif pad_mm:
-#             pad_units = [Unit(millimeter=p) for p in pad_mm]
-#         elif pad_inches:
-#             pad_units = [Unit(inches=p) for p in pad_inches]
-        
-#         contain_units = None
-#         if contain_pixels:
-#             contain_units = [Unit(pixels=p) for p in contain_pixels]
-#         elif contain_mm:
-#             contain_units = [Unit(millimeter=p) for p in contain_mm]
-#         elif contain_inches:
-#             contain_units = [Unit(inches=p) for p in contain_inches]
-        
-#         stickerise_unit = None
-#         if stickerise_pixels:
-#             stickerise_unit = Unit(pixels=stickerise_pixels)
-#         elif stickerise_mm:
-#             stickerise_unit = Unit(millimeter=stickerise_mm)
-#         elif stickerise_inches:
-#             stickerise_unit = Unit(inches=stickerise_inches)
-        
-#         expand_unit = None
-#         if expand_pixels:
-#             expand_unit = Unit(pixels=expand_pixels)
-#         elif expand_mm:
-#             expand_unit = Unit(millimeter=expand_mm)
-#         elif expand_inches:
-#             expand_unit = Unit(inches=expand_inches)
+async def _temp_blob_url(extension: str) -> str:
+    temp_blob = await _tool_fn(generate_temp_blob)(extension=extension)
+    if "error" in temp_blob:
+        raise RuntimeError(temp_blob.get("details") or temp_blob["error"])
+    return temp_blob["temp_url"]
+
+
+async def _transform_pdf_chunk(data: bytes, transform: Dict[str, Any], source: Optional[str]) -> Dict[str, Any]:
+    """Uploads one chunk to a temp blob, queues its transform job and waits for the output blob."""
+    input_url, output_url = await asyncio.gather(_temp_blob_url("pdf"), _temp_blob_url("pdf"))
+    await _put_blob(input_url, data, "application/pdf")
+    request_body = {
+        "source_image_url": input_url,
+        "output_image_url": output_url,
+        "client_transform_id": str(uuid.uuid4()),
+        "transform": transform,
+        **({"source": source} if source else {}),
+    }
+    async with _host_semaphore(BASE_URL):
+        response = await _http_client().post(
+            f"{BASE_URL}/transform",
+            content=_json_dumps(request_body),
+            headers={"x-api-key": API_KEY, "Content-Type": "application/json"},
+            timeout=_upstream_timeout(30.0),
+        )
+    response.raise_for_status()
+    job_id = (await _parse_json(response)).get("transform_job_id")
+    
+    give_up_at = _call_deadline.get() or time.monotonic() + TOOL_CALL_TIMEOUT_SECONDS
+    while True:
+        status = await _transform_job_status(output_url)
+        if status == "completed":
+            return {"transform_job_id": job_id, "output_url": output_url}
+        if status == "failed":
+            raise RuntimeError(f"Transform job {job_id} failed")
+        if time.monotonic() > give_up_at:
+            raise TimeoutError(f"Transform job {job_id} did not finish")
+        await asyncio.sleep(_upstream_timeout(PDF_CHUNK_POLL_SECONDS))
+
+
+async def _transform_pdf_in_chunks(
+    source_image_url: str,
+    output_image_url: Optional[str],
+    transform: Dict[str, Any],
+    pages_per_chunk: int,
+    source: Optional[str],
+) -> Optional[Dict[str, Any]]:
+    """Transforms a multi-page PDF as parallel jobs of `pages_per_chunk` pages each.
+    
+    Returns None without downloading the source when its page count, read from the
+    header and tail of the file, shows it fits in one chunk. Otherwise chunks are cut
+    from a local copy of the source one at a time, and at most PDF_CHUNK_CONCURRENCY
+    are in flight: the next chunk is only written once a slot frees up. The outputs
+    are merged in page order and uploaded to output_image_url (or a temp blob).
+    
+    Everything runs within the tool call's deadline; when it passes, queued chunk jobs are
+    abandoned and nothing is returned for them.
+    """
+    probe = await _read_blob_metadata(_http_client(), source_image_url)
+    probed_pages = (probe.get("metadata") or {}).get("page_count")
+    if probed_pages is not None and probed_pages <= pages_per_chunk:
+        return None
+    
+    slots = asyncio.Semaphore(PDF_CHUNK_CONCURRENCY)
+    
+    async def in_slot(make_work):
+        # The coroutine is only created once it holds a slot, so a cancelled job never leaves
+        # one behind un-awaited
+        try:
+            return await make_work()
+        finally:
+            slots.release()
+    
+    source_pdf = await _download_to_spool(source_image_url)
+    jobs: List[asyncio.Future] = []
+    try:
+        reader = await asyncio.to_thread(pypdf.PdfReader, source_pdf)
+        page_count = len(reader.pages)
+        if page_count <= pages_per_chunk:
+            return None
+        ranges = [(start, min(start + pages_per_chunk, page_count)) for start in range(0, page_count, pages_per_chunk)]
+        for start, stop in ranges:
+            await slots.acquire()
+            for job in jobs:
+                if job.done():
+                    # Stop cutting chunks as soon as one has failed
+                    job.result()
+            # The reader shares one file, so chunks are written one after another
+            try:
+                data = await asyncio.to_thread(_write_pdf_pages, reader, start, stop)
+            except BaseException:
+                slots.release()
+                raise
+            jobs.append(asyncio.ensure_future(in_slot(functools.partial(_transform_pdf_chunk, data, transform, source))))
+        results = await asyncio.gather(*jobs)
+    except BaseException:
+        for job in jobs:
+            job.cancel()
+        raise
+    finally:
+        source_pdf.close()
+    
+    async def download(url: str):
+        await slots.acquire()
+        return await in_slot(functools.partial(_download_to_spool, url))
+    
+    outputs = await asyncio.gather(*(download(result["output_url"]) for result in results), return_exceptions=True)
+    failed = next((output for output in outputs if isinstance(output, BaseException)), None)
+    if failed is not None:
+        for output in outputs:
+            if not isinstance(output, BaseException):
+                output.close()
+        raise failed
+    try:
+        merged = await asyncio.to_thread(_merge_pdf_chunks, outputs, transform.get("same_pixel_size") is not False)
+    finally:
+        for output in outputs:
+            output.close()
+    with merged:
+        if not output_image_url:
+            output_image_url = await _temp_blob_url("pdf")
+        upload = await _upload_stream_to_blob(_iter_spool(merged), output_image_url, "application/pdf")
+    
+    return {
+        "success": True,
+        "message": f"Transformed {page_count} pages in {len(ranges)} parallel jobs",
+        "output_url": output_image_url,
+        "pages": page_count,
+        "jobs": [
+            {"transform_job_id": result["transform_job_id"], "pages": [start + 1, stop]}
+            for result, (start, stop) in zip(results, ranges)
+        ],
+        **upload,
+        "status": "completed",
+    }
+
+
+@mcp.tool(
+    title="Image Transformer (Sync)",
+    description="""Transform an image synchronously, for small, latency-sensitive jobs.
+    
+    Takes the same transform parameters as async_image_transformation, plus:
+    - output_image_url: (optional) Blob SAS URL to write the result to. A temporary
+      blob URL is generated when omitted
+    - inline: Return the result as an image content block instead of uploading it.
+      Only for images up to SYNC_INLINE_MAX_BYTES (default 1 MB); PDFs must be uploaded
+    
+    The result is streamed from the API straight into the blob, never buffered in full.
+    Use async_image_transformation for large images, PDFs or batches.
+    
+    Returns output_url (always return this signed URL when completing the task),
+    content_type and size_bytes, or the image itself when inline is set."""
+)
+@_with_transform_params
+async def transform_image(
+    source_image_url: str,
+    output_image_url: Optional[str] = None,
+    inline: bool = False,
+    optimize: bool = False,
+    **transform,
+) -> Dict[str, Any]:
+    
+    if not API_KEY:
+        return {"error": "API key not configured. Please set PORCUS_LARDUM_API_KEY environment variable."}
+    
+    try:
+        transform_params = _build_transform_params(**transform)
         
-#         transform_params = ImageOpsTransformParamsIn(
-#             image_ops=True,
-#             crop=crop_units,
-#             crop_box=crop_box_units,
-#             crop_aspect_ratio=crop_aspect_ratio,
-#             pad=pad_units,
-#             contain=contain_units,
-#             override_dpi=override_dpi,
-#             rotate=rotate,
-#             rotate_to=rotate_to,
-#             overwrite_partial_transparency=overwrite_partial_transparency,
-#             transparency_to_color=transparency_to_color,
-#             grayscale=grayscale,
-#             pdf=pdf,
-#             multi_page=multi_page,
-#             same_pixel_size=same_pixel_size,
-#             stickerise=stickerise_unit,
-#             expand=expand_unit,
-#         )
+        optimizations = []
+        if optimize:
+            transform_params, optimizations = _optimize_transform(transform_params)
         
-#         request_body = {
-#             "source_image_url": source_image_url,
-#             "transform": transform_params.model_dump(exclude_none=True)
-#         }
+        request_body = {
+            "source_image_url": source_image_url,
+            "transform": transform_params.model_dump(exclude_none=True)
+        }
         
-#         async with httpx.AsyncClient() as client:
-#             response = await client.post(
-#                 f"{BASE_URL}/sync_transform",
-#                 json=request_body,
-#                 headers={
-#                     "x-api-key": API_KEY,
-#                     "Content-Type": "application/json",
-#                 },
-#                 timeout=30.0,
-#             )
-            
-#             if response.status_code == 200:
-#                 # Check if response is JSON or binary image data
-#                 content_type = response.headers.get("content-type", "")
-#                 if "application/json" in content_type:
-#                     result = response.json()
-#                     return {
-#                         "success": True,
-#                         "transformed_url": result.get("url"),
-#                         "metadata": result.get("metadata", {}),
-#                         "processing_time": result.get("processing_time"),
-#                     }
-#                 else:
-#                     # Response is binary image data
-#                     # Save to disk with appropriate extension
-#                     ext = "jpg"
-#                     if "png" in content_type:
-#                         ext = "png"
-#                     elif "gif" in content_type:
-#                         ext = "gif"
-#                     elif "webp" in content_type:
-#                         ext = "webp"
-                    
-#                     filename = f"transformed_image.{ext}"
-#                     with open(filename, "wb") as f:
-#                         f.write(response.content)
-                    
-#                     return {
-#                         "success": True,
-#                         "message": "Image transformed successfully",
-#                         "saved_to": filename,
-#                         "content_type": content_type,
-#                         "size": len(response.content),
-#                     }
-#             else:
-#                 return {
-#                     "error": f"API request failed with status {response.status_code}",
-#                     "details": response.text,
-#                 }
+        async with _upstream_client() as client:
+            async with client.stream(
+                "POST",
+                f"{BASE_URL}/sync_transform",
+                content=_json_dumps(request_body),
+                headers={
+                    "x-api-key": API_KEY,
+                    "Content-Type": "application/json",
+                },
+                timeout=_upstream_timeout(60.0),
+            ) as response:
+                
+                if response.status_code != 200:
+                    await response.aread()
+                    return {
+                        "error": f"API request failed with status {response.status_code}",
+                        "details": response.text,
+                    }
+                
+                content_type = response.headers.get("content-type", "")
+                if "application/json" in content_type:
+                    # The API stored the result itself and returned its URL
+                    result = await _parse_json(response)
+                    return {
+                        "success": True,
+                        "output_url": result.get("url"),
+                        "metadata": result.get("metadata", {}),
+                        "processing_time": result.get("processing_time"),
+                        "optimizations": optimizations,
+                    }
                 
-#     except Exception as e:
-#         return {"error": f"Failed to transform image: {str(e)}"}
+                if inline:
+                    if not content_type.startswith("image/"):
+                        return {"error": f"Cannot return {content_type or 'unknown content'} inline; omit inline to upload it"}
+                    too_large = {
+                        "error": f"Result exceeds the {SYNC_INLINE_MAX_BYTES} byte inline limit",
+                        "details": "Omit inline to upload it to a blob instead",
+                    }
+                    if int(response.headers.get("content-length") or 0) > SYNC_INLINE_MAX_BYTES:
+                        return too_large
+                    data = bytearray()
+                    async for chunk in response.aiter_bytes(STREAM_CHUNK_SIZE):
+                        data.extend(chunk)
+                        if len(data) > SYNC_INLINE_MAX_BYTES:
+                            return too_large
+                    metadata, _ = _parse_image_header(bytes(data[:HEADER_PROBE_BYTES]))
+                    return ToolResult(
+                        content=[ImageContent(type="image", data=base64.b64encode(data).decode(), mimeType=content_type)],
+                        structured_content={
+                            "success": True,
+                            "content_type": content_type,
+                            "size_bytes": len(data),
+                            "metadata": metadata,
+                            "optimizations": optimizations,
+                        },
+                    )
+                
+                if not output_image_url:
+                    temp_blob = await _tool_fn(generate_temp_blob)(extension=_blob_extension(content_type))
+                    if "error" in temp_blob:
+                        return temp_blob
+                    output_image_url = temp_blob["temp_url"]
+                
+                upload = await _upload_stream_to_blob(
+                    response.aiter_bytes(STREAM_CHUNK_SIZE), output_image_url, content_type
+                )
+                return {
+                    "success": True,
+                    "message": "Image transformed successfully",
+                    "output_url": output_image_url,
+                    "content_type": content_type,
+                    **upload,
+                    "optimizations": optimizations,
+                }
+    
+    except httpx.HTTPStatusError as e:
+        return {
+            "error": f"Failed to upload transformed image. Status: {e.response.status_code}",
+            "details": e.response.text,
+        }
+    except Exception as e:
+        return {"error": f"Failed to transform image: {str(e)}"}
 
 @mcp.tool(
     title="Generate Temp Blob URL",
@@ -300,14 +2474,14 @@ async def generate_temp_blob(extension: Optional[str] = None) -> Dict[str, Any]:
         if extension and extension in ['png', 'jpg', 'pdf']:
             params['extension'] = extension
         
-        async with httpx.AsyncClient() as client:
+        async with _upstream_client() as client:
             response = await client.get(
                 f"{BASE_URL}/temp_blob",
                 params=params,
                 headers={
                     "x-api-key": API_KEY,
                 },
-                timeout=30.0,
+                timeout=_upstream_timeout(30.0),
             )
             
             if response.status_code == 200:
@@ -375,6 +2549,20 @@ async def generate_temp_blob(extension: Optional[str] = None) -> Dict[str, Any]:
       Useful for padding sticker images.
     - expand_inches: Add uniform border by expanding canvas in inches. 
       Useful for padding sticker images.
+    - transforms_array: Custom transform sequence, each step a dict of the
+      transform fields above in API form (e.g. {"crop": [{"pixels": 10}]}),
+      applied after the top-level options
+    - optimize: Drop no-op steps, fold right-angle rotations and merge consecutive crops
+      before submitting (default: false). Changes are listed in "optimizations"
+    - dry_run: Read the source header and return the planned output geometry
+      (see plan_image_transformation) without queueing a job
+    - pages_per_chunk: With multi_page, split the source PDF into chunks of this many
+      pages, transform them as parallel jobs and merge the results in page order.
+      Waits for the jobs and returns the finished output_url and one job per chunk.
+      The whole file must finish within the tool call deadline (TOOL_CALL_TIMEOUT_SECONDS,
+      default 120 s); use multi_page alone for files that take longer
+    - reuse_existing: Return an identical job that is already queued or done instead of
+      submitting a new one (default: true). Set false to retry a job that never finished
 
     Returns a transform_job_id for tracking the asynchronous job.
 
@@ -382,130 +2570,60 @@ async def generate_temp_blob(extension: Optional[str] = None) -> Dict[str, Any]:
     * Very Important:Always return the signed url output_image_url when completing the task.
     """
 )
+@_with_transform_params
 async def async_image_transformation(
     source_image_url: str,
     output_image_url: Optional[str] = None,
     client_transform_id: Optional[str] = None,
     source: Optional[str] = None,
-    crop_pixels: Optional[List[int]] = None,
-    crop_mm: Optional[List[float]] = None,
-    crop_inches: Optional[List[float]] = None,
-    crop_box_pixels_offset: Optional[List[int]] = None,
-    crop_box_mm_offset: Optional[List[float]] = None,
-    crop_box_inches_offset: Optional[List[float]] = None,
-    crop_box_pixels: Optional[List[int]] = None,
-    crop_box_mm: Optional[List[float]] = None,
-    crop_box_inches: Optional[List[float]] = None,
-    crop_aspect_ratio: Optional[float] = None,
-    pad_pixels: Optional[List[int]] = None,
-    pad_mm: Optional[List[float]] = None,
-    pad_inches: Optional[List[float]] = None,
-    contain_pixels: Optional[List[int]] = None,
-    contain_mm: Optional[List[float]] = None,
-    contain_inches: Optional[List[float]] = None,
-    override_dpi: Optional[int] = None,
-    rotate: Optional[int] = None,
-    rotate_to: Optional[str] = None,
-    overwrite_partial_transparency: Optional[int] = None,
-    transparency_to_color: Optional[List[int]] = None,
-    grayscale: Optional[bool] = None,
-    pdf: Optional[bool] = None,
-    multi_page: Optional[bool] = None,
-    same_pixel_size: Optional[bool] = None,
-    stickerise_pixels: Optional[int] = None,
-    stickerise_mm: Optional[float] = None,
-    stickerise_inches: Optional[float] = None,
-    expand_pixels: Optional[int] = None,
-    expand_mm: Optional[float] = None,
-    expand_inches: Optional[float] = None,
+    optimize: bool = False,
+    dry_run: Optional[bool] = None,
+    pages_per_chunk: Optional[int] = None,
+    reuse_existing: bool = True,
+    **transform,
 ) -> Dict[str, Any]:
     
-    if not API_KEY:
+    if not API_KEY and not dry_run:
         return {"error": "API key not configured. Please set PORCUS_LARDUM_API_KEY environment variable."}
     
     try:
         # Generate client_transform_id if not provided
-        import uuid
         if not client_transform_id:
             client_transform_id = str(uuid.uuid4())
         
-        # Convert values to Unit objects
-        crop_units = None
-        if crop_pixels:
-            crop_units = [Unit(pixels=p) for p in crop_pixels]
-        elif crop_mm:
-            crop_units = [Unit(millimeter=p) for p in crop_mm]
-        elif crop_inches:
-            crop_units = [Unit(inches=p) for p in crop_inches]
-        
-        crop_box_units = None
-        if crop_box_pixels:
-            crop_box_units = [[Unit(pixels=p) for p in crop_box_pixels]] if not crop_box_pixels_offset else [
-                [Unit(pixels=p) for p in crop_box_pixels],
-                [Unit(pixels=p) for p in crop_box_pixels_offset]
-            ]
-        elif crop_box_mm:
-            crop_box_units = [[Unit(millimeter=p) for p in crop_box_mm]] if not crop_box_mm_offset else [
-                [Unit(millimeter=p) for p in crop_box_mm],
-                [Unit(millimeter=p) for p in crop_box_mm_offset]
-            ]
-        elif crop_box_inches:
-            crop_box_units = [[Unit(inches=p) for p in crop_box_inches]] if not crop_box_inches_offset else [
-                [Unit(inches=p) for p in crop_box_inches],
-                [Unit(inches=p) for p in crop_box_inches_offset]
-            ]
-
-        pad_units = None
-        if pad_pixels:
-            pad_units = [Unit(pixels=p) for p in pad_pixels]
-        elif pad_mm:
-            pad_units = [Unit(millimeter=p) for p in pad_mm]
-        elif pad_inches:
-            pad_units = [Unit(inches=p) for p in pad_inches]
-        
-        contain_units = None
-        if contain_pixels:
-            contain_units = [Unit(pixels=p) for p in contain_pixels]
-        elif contain_mm:
-            contain_units = [Unit(millimeter=p) for p in contain_mm]
-        elif contain_inches:
-            contain_units = [Unit(inches=p) for p in contain_inches]
+        transform_params = _build_transform_params(**transform)
         
-        stickerise_unit = None
-        if stickerise_pixels:
-            stickerise_unit = Unit(pixels=stickerise_pixels)
-        elif stickerise_mm:
-            stickerise_unit = Unit(millimeter=stickerise_mm)
-        elif stickerise_inches:
-            stickerise_unit = Unit(inches=stickerise_inches)
+        optimizations = []
+        if optimize:
+            transform_params, optimizations = _optimize_transform(transform_params)
         
-        expand_unit = None
-        if expand_pixels:
-            expand_unit = Unit(pixels=expand_pixels)
-        elif expand_mm:
-            expand_unit = Unit(millimeter=expand_mm)
-        elif expand_inches:
-            expand_unit = Unit(inches=expand_inches)
+        if dry_run:
+            plan = await _plan_for_source(transform_params, source_image_url=source_image_url)
+            return {
+                **plan,
+                "dry_run": True,
+                "transform": transform_params.model_dump(exclude_none=True),
+                "optimizations": optimizations,
+            }
         
-        transform_params = ImageOpsTransformParamsIn(
-            image_ops=True,
-            crop=crop_units,
-            crop_box=crop_box_units,
-            crop_aspect_ratio=crop_aspect_ratio,
-            pad=pad_units,
-            contain=contain_units,
-            override_dpi=override_dpi,
-            rotate=rotate,
-            rotate_to=rotate_to,
-            overwrite_partial_transparency=overwrite_partial_transparency,
-            transparency_to_color=transparency_to_color,
-            grayscale=grayscale,
-            pdf=pdf,
-            multi_page=multi_page,
-            same_pixel_size=same_pixel_size,
-            stickerise=stickerise_unit,
-            expand=expand_unit,
-        )
+        if pages_per_chunk and transform_params.multi_page:
+            if pypdf is None:
+                return {"error": "pages_per_chunk requires the pypdf package"}
+            try:
+                result = await _transform_pdf_in_chunks(
+                    source_image_url,
+                    output_image_url,
+                    transform_params.model_dump(exclude_none=True),
+                    pages_per_chunk,
+                    source,
+                )
+            except httpx.HTTPStatusError as e:
+                return {
+                    "error": f"PDF chunk request failed with status {e.response.status_code}",
+                    "details": e.response.text,
+                }
+            if result is not None:
+                return {**result, "client_transform_id": client_transform_id, "optimizations": optimizations}
         
         request_body = {
             "source_image_url": source_image_url,
@@ -522,36 +2640,234 @@ async def async_image_transformation(
         if source:
             request_body["source"] = source
         
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{BASE_URL}/transform",
-                json=request_body,
-                headers={
-                    "x-api-key": API_KEY,
-                    "Content-Type": "application/json",
-                },
-                timeout=30.0,
-            )
+        content = _json_dumps(request_body)
+        
+        async def submit() -> Dict[str, Any]:
+            async with _upstream_client() as client:
+                response = await client.post(
+                    f"{BASE_URL}/transform",
+                    content=content,
+                    headers={
+                        "x-api-key": API_KEY,
+                        "Content-Type": "application/json",
+                    },
+                    timeout=_upstream_timeout(30.0),
+                )
+                
+                if response.status_code == 200:
+                    result = await _parse_json(response)
+                    return {
+                        "success": True,
+                        "transform_job_id": result.get("transform_job_id"),
+                        "client_transform_id": client_transform_id,
+                        "message": "Async transformation job queued successfully",
+                        "output_url": result.get("output_image_url"),
+                        "raw_request_body": content.decode(),
+                        "optimizations": optimizations,
+                        "status": "queued"
+                    }
+                else:
+                    return {
+                        "error": f"API request failed with status {response.status_code}",
+                        "details": response.text,
+                    }
+        
+        return await _deduplicated_transform(request_body, submit, reuse_existing)
+                
+    except Exception as e:
+        return {"error": f"Failed to queue async transformation: {str(e)}"}
+
+@mcp.tool(
+    title="Plan Image Transformation",
+    description="""Dry-run an image transformation locally and report the resulting geometry.
+    
+    Takes the same transform parameters as async_image_transformation, plus:
+    - source_width / source_height: Source size in pixels
+    - source_dpi: Source DPI, needed to convert mm/inches values
+    - source_image_url: (optional) Read the size and DPI from this image's header instead
+    
+    Applies crop, crop_box, crop_aspect_ratio, pad, contain, rotate, rotate_to,
+    stickerise and expand in order and returns each intermediate size, the final
+    canvas size, orientation, effective DPI and physical size. Nothing is queued.
+    
+    Use this to iterate on geometry before calling async_image_transformation."""
+)
+@_with_transform_params
+async def plan_image_transformation(
+    source_width: Optional[int] = None,
+    source_height: Optional[int] = None,
+    source_dpi: Optional[float] = None,
+    source_image_url: Optional[str] = None,
+    **transform,
+) -> Dict[str, Any]:
+    
+    try:
+        transform_params = _build_transform_params(**transform)
+        return await _plan_for_source(
+            transform_params,
+            source_image_url=source_image_url,
+            source_width=source_width,
+            source_height=source_height,
+            source_dpi=source_dpi,
+        )
+    
+    except Exception as e:
+        return {"error": f"Failed to plan transformation: {str(e)}"}
+
+def _tool_fn(tool: Any) -> Any:
+    # @mcp.tool returns a Tool wrapping the function in newer FastMCP releases
+    return getattr(tool, "fn", tool)
+
+
+if COMPACT_MANIFEST:
+    # Same behaviour, with nested unit-tagged parameters instead of pixels/mm/inches triplets
+    mcp.remove_tool("async_image_transformation")
+    mcp.tool(
+        name="async_image_transformation",
+        title="Image Transformer (Async)",
+        description="""Queue an image transformation job. Sizes are {unit, values} objects
+    in pixels, mm or inches; crop is [top, right, bottom, left] or one value for all,
+    pad/contain are [width, height]. Set expand larger than stickerise.
+    pages_per_chunk (with multi_page) transforms PDF page chunks in parallel and waits.
+    Returns transform_job_id and output_url. Always return output_url when done.""",
+    )(_with_transform_params(_tool_fn(async_image_transformation).__wrapped__, compact=True))
+    mcp.remove_tool("plan_image_transformation")
+    mcp.tool(
+        name="plan_image_transformation",
+        title="Plan Image Transformation",
+        description="""Dry-run a transformation locally (same parameters as
+    async_image_transformation plus source size/DPI or source_image_url) and return the
+    resulting size, orientation and DPI of each step. Nothing is queued.""",
+    )(_with_transform_params(_tool_fn(plan_image_transformation).__wrapped__, compact=True))
+    mcp.remove_tool("transform_image")
+    mcp.tool(
+        name="transform_image",
+        title="Image Transformer (Sync)",
+        description="""Transform a small image synchronously (same parameters as
+    async_image_transformation). Streams the result to output_image_url or a temp blob,
+    or returns it as an image when inline is set. Always return output_url when done.""",
+    )(_with_transform_params(_tool_fn(transform_image).__wrapped__, compact=True))
+
+
+@mcp.tool(
+    title="List Transform Presets",
+    description="""List the named transform presets accepted by apply_preset.
+    
+    Returns each preset's description, the parameters it requires and its
+    overridable parameters with defaults."""
+)
+async def list_transform_presets() -> Dict[str, Any]:
+    return {
+        "success": True,
+        "presets": {
+            name: {
+                "description": preset["description"],
+                "required": preset.get("required", []),
+                "parameters": preset["defaults"],
+            }
+            for name, preset in TRANSFORM_PRESETS.items()
+        },
+    }
+
+
+@mcp.tool(
+    title="Apply Transform Preset",
+    description="""Queue a named transform preset for one or many source images.
+    
+    Parameters:
+    - preset: Preset name (see list_transform_presets), e.g. 'print_ready',
+      'stickerise', 'transparency_to_white', 'pdf_multipage'
+    - source_image_urls: One or more URLs of images to transform
+    - overrides: Preset parameters, e.g. {"dpi": 600} for print_ready. Required for
+      presets with required parameters, e.g. {"width": 800, "height": 600} for crop_box
+    - output_image_urls: (optional) Output URLs, one per source image
+    - source: Optional source identifier for job correlation
+    - reuse_existing: Return identical jobs that are already queued or done instead of
+      submitting new ones (default: true). Set false to retry jobs that never finished
+    
+    Presets are validated once and submitted directly, so no individual
+    transform parameters need to be filled in.
+    Returns one transform_job_id and output_url per source image.
+    
+    * Always return the output_url values when completing the task."""
+)
+async def apply_preset(
+    preset: str,
+    source_image_urls: List[str],
+    overrides: Optional[Dict[str, Any]] = None,
+    output_image_urls: Optional[List[str]] = None,
+    source: Optional[str] = None,
+    reuse_existing: bool = True,
+) -> Dict[str, Any]:
+    
+    if not API_KEY:
+        return {"error": "API key not configured. Please set PORCUS_LARDUM_API_KEY environment variable."}
+    if preset not in TRANSFORM_PRESETS:
+        return {"error": f"Unknown preset {preset}. Available: {', '.join(TRANSFORM_PRESETS)}"}
+    if output_image_urls and len(output_image_urls) != len(source_image_urls):
+        return {"error": "output_image_urls must have one entry per source image URL"}
+    
+    try:
+        transform = _json_loads(_compile_preset(preset, json.dumps(overrides or {}, sort_keys=True)))
+        
+        async def submit(index: int, source_image_url: str, client: httpx.AsyncClient) -> Dict[str, Any]:
+            client_transform_id = str(uuid.uuid4())
+            fields = {"source_image_url": source_image_url, "client_transform_id": client_transform_id}
+            if output_image_urls:
+                fields["output_image_url"] = output_image_urls[index]
+            if source:
+                fields["source"] = source
+            request_body = {**fields, "transform": transform}
             
-            if response.status_code == 200:
-                result = response.json()
-                return {
-                    "success": True,
-                    "transform_job_id": result.get("transform_job_id"),
-                    "client_transform_id": client_transform_id,
-                    "message": "Async transformation job queued successfully",
-                    "output_url": result.get("output_image_url"),
-                    "raw_request_body": json.dumps(request_body),
-                    "status": "queued"
-                }
-            else:
+            async def post() -> Dict[str, Any]:
+                async with _host_semaphore(BASE_URL):
+                    response = await client.post(
+                        f"{BASE_URL}/transform",
+                        content=_json_dumps(request_body),
+                        headers={
+                            "x-api-key": API_KEY,
+                            "Content-Type": "application/json",
+                        },
+                        timeout=_upstream_timeout(30.0),
+                    )
+                if response.status_code == 200:
+                    result = await _parse_json(response)
+                    return {
+                        "source_image_url": source_image_url,
+                        "transform_job_id": result.get("transform_job_id"),
+                        "client_transform_id": client_transform_id,
+                        "output_url": result.get("output_image_url"),
+                        "status": "queued",
+                    }
                 return {
+                    "source_image_url": source_image_url,
                     "error": f"API request failed with status {response.status_code}",
                     "details": response.text,
                 }
-                
+            
+            return await _deduplicated_transform(request_body, post, reuse_existing)
+        
+        async with _upstream_client() as client:
+            jobs = await asyncio.gather(
+                *(submit(i, url, client) for i, url in enumerate(source_image_urls)),
+                return_exceptions=True,
+            )
+        jobs = [
+            {"source_image_url": url, "error": f"Failed to queue transformation: {str(job)}"}
+            if isinstance(job, Exception) else job
+            for url, job in zip(source_image_urls, jobs)
+        ]
+        
+        return {
+            "success": all("error" not in job for job in jobs),
+            "preset": preset,
+            "transform": transform,
+            "jobs": jobs,
+            "message": f"Queued {sum('error' not in job for job in jobs)} of {len(jobs)} jobs",
+        }
+    
     except Exception as e:
-        return {"error": f"Failed to queue async transformation: {str(e)}"}
+        return {"error": f"Failed to apply preset: {str(e)}"}
 
 @mcp.prompt()
 def crop_image_prompt(width: int = 0, height: int = 0, offset_x: int = 100, offset_y: int = 100) -> str:
@@ -826,6 +3142,8 @@ This will return:
     - output_image_url: (optional) URL where the processed image will be delivered
     - client_transform_id: Optional client ID for tracking (default: generated UUID)
     - source: Optional source identifier for job correlation
+    - reuse_existing: Return an identical job that is already queued or done instead of
+      submitting a new one (default: true). Set false to retry a job that never finished
     
     This uses AI-powered background removal on Azure Kubernetes GPU cluster.
     Returns a transform_job_id for tracking the asynchronous job.
@@ -835,8 +3153,9 @@ This will return:
 async def remove_background(
     source_image_url: str,
     output_image_url: Optional[str] = None,
+    reuse_existing: bool = True,
 ) -> Dict[str, Any]:
-    print("Removing background from image...")
+    logger.debug("Removing background", extra={"fields": {"source_image_url": source_image_url}})
     if not API_KEY:
         return {"error": "API key not configured. Please set PORCUS_LARDUM_API_KEY environment variable."}
     
@@ -850,37 +3169,197 @@ async def remove_background(
 
         request_body.update({"output_image_url": output_image_url} if output_image_url else {})
 
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{BASE_URL}/transform",
-                json=request_body,
-                headers={
-                    "x-api-key": API_KEY,
-                    "Content-Type": "application/json",
-                },
-                timeout=30.0,
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                return {
-                    "success": True,
-                    "transform_job_id": result.get("transform_job_id"),
-                    "message": "Background removal job queued successfully",
-                    "output_url": result.get("output_image_url"),
-                    "raw_request_body": json.dumps(request_body),
-                    "status": "queued"
-                }
-            else:
-                return {
-                    "error": f"API request failed with status {response.status_code}",
-                    "details": response.text,
-                }
+        content = _json_dumps(request_body)
+        
+        async def submit() -> Dict[str, Any]:
+            async with _upstream_client() as client:
+                response = await client.post(
+                    f"{BASE_URL}/transform",
+                    content=content,
+                    headers={
+                        "x-api-key": API_KEY,
+                        "Content-Type": "application/json",
+                    },
+                    timeout=_upstream_timeout(30.0),
+                )
+                
+                if response.status_code == 200:
+                    result = await _parse_json(response)
+                    return {
+                        "success": True,
+                        "transform_job_id": result.get("transform_job_id"),
+                        "message": "Background removal job queued successfully",
+                        "output_url": result.get("output_image_url"),
+                        "raw_request_body": content.decode(),
+                        "status": "queued"
+                    }
+                else:
+                    return {
+                        "error": f"API request failed with status {response.status_code}",
+                        "details": response.text,
+                    }
+        
+        return await _deduplicated_transform(request_body, submit, reuse_existing)
                 
     except Exception as e:
         return {"error": f"Failed to queue background removal: {str(e)}"}
 
 
+@mcp.tool(
+    title="Inspect Output Image",
+    description="""Stream a transformed output (image or PDF) and report its checksum and metadata.
+    
+    Parameters:
+    - output_url: https URL of the output to inspect (usually the output_url of a transform
+      job), on Azure Blob Storage or another host in FETCH_ALLOWED_HOSTS
+    - header_only: Only read the leading bytes needed for metadata, skipping the checksum
+    - checksum_algorithm: Hash algorithm for the checksum (default: sha256)
+    
+    The blob is read in chunks and never buffered in full. Returns the size,
+    content type, checksum and format metadata: pixel dimensions and DPI for
+    PNG/JPEG/GIF/WebP, page count and page size for PDFs.
+    
+    Use this to confirm an output is complete and correctly sized before using it."""
+)
+async def inspect_output_image(
+    output_url: str,
+    header_only: bool = False,
+    checksum_algorithm: str = "sha256",
+) -> Dict[str, Any]:
+    
+    # shake_* digests have no fixed length, so hexdigest() would need one
+    if checksum_algorithm not in hashlib.algorithms_guaranteed or checksum_algorithm.startswith("shake_"):
+        return {"error": f"Unsupported checksum algorithm: {checksum_algorithm}"}
+    
+    try:
+        _check_fetch_url(output_url)
+        async with _upstream_client() as client:
+            return await _read_blob_metadata(client, output_url, header_only, checksum_algorithm)
+                
+    except Exception as e:
+        return {"error": f"Failed to inspect output: {str(e)}"}
+
+
+# Recent previews by URL and size, so repeated looks at the same image are instant
+_previews = MemoryCache(PREVIEW_CACHE_ENTRIES)
+
+
+def _pdf_image_xobjects(resources, seen: set) -> Iterator[Any]:
+    """Yields the image XObjects of a page's resources, including those inside form XObjects."""
+    xobjects = (resources or {}).get("/XObject")
+    for reference in (xobjects.get_object() if xobjects else {}).values():
+        xobject = reference.get_object()
+        if id(xobject) in seen:
+            continue
+        seen.add(id(xobject))
+        if xobject.get("/Subtype") == "/Image":
+            yield xobject
+        elif xobject.get("/Subtype") == "/Form":
+            yield from _pdf_image_xobjects(xobject.get("/Resources"), seen)
+
+
+def _pdf_first_page_image(source) -> "Image.Image":
+    """Returns the largest raster image on the PDF's first page (print PDFs wrap one image per page).
+    
+    Images are compared by their declared size, so only the chosen one is decoded. JPEG and
+    JPEG 2000 data is handed to Pillow as-is, so the preview's thumbnail() can decode it at
+    reduced scale.
+    """
+    page = pypdf.PdfReader(source).pages[0]
+    xobjects = list(_pdf_image_xobjects(page.get("/Resources"), set()))
+    if not xobjects:
+        raise ValueError(
+            "The PDF's first page has no embedded raster image; vector-only pages can't be previewed"
+        )
+    xobject = max(xobjects, key=lambda image: int(image.get("/Width", 0)) * int(image.get("/Height", 0)))
+    filters = xobject.get("/Filter")
+    filters = [filters] if isinstance(filters, str) else list(filters or [])
+    if filters and filters[-1] in ("/DCTDecode", "/JPXDecode"):
+        image = Image.open(io.BytesIO(xobject.get_data()))
+        # CMYK JPEGs in PDFs are often stored inverted, which pypdf corrects for
+        if image.mode != "CMYK":
+            return image
+    return xobject.decode_as_image()
+
+
+def _render_preview(source, max_size: int) -> Tuple[bytes, str, Dict[str, Any]]:
+    if source.read(5) == b"%PDF-":
+        if pypdf is None:
+            raise ValueError("PDF previews require the pypdf package")
+        source.seek(0)
+        image = _pdf_first_page_image(source)
+        source_format = "pdf"
+    else:
+        source.seek(0)
+        try:
+            image = Image.open(source)
+        except Image.UnidentifiedImageError:
+            raise ValueError("Unsupported image format") from None
+        source_format = (image.format or "unknown").lower()
+    source_size = image.size
+    # thumbnail() first asks the decoder for a reduced draft (JPEG DCT scaling), then resamples
+    image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+    
+    output = io.BytesIO()
+    if image.mode in ("RGBA", "LA", "P") and (image.mode != "P" or "transparency" in image.info):
+        image.convert("RGBA").save(output, "PNG", optimize=True)
+        mime_type = "image/png"
+    else:
+        image.convert("RGB").save(output, "JPEG", quality=PREVIEW_JPEG_QUALITY)
+        mime_type = "image/jpeg"
+    metadata = {
+        "source_format": source_format,
+        "source_size": list(source_size),
+        "preview_size": list(image.size),
+        "preview_bytes": output.tell(),
+    }
+    return output.getvalue(), mime_type, metadata
+
+
+@mcp.tool(
+    title="Preview Image",
+    description="""Return a small preview of an image or PDF so it can be looked at directly.
+    
+    Parameters:
+    - image_url: https URL of a source image or a transform output, on Azure Blob Storage
+      or another host in FETCH_ALLOWED_HOSTS
+    - max_size: Longest side of the preview in pixels (default: 512, at most 1024)
+    
+    JPEGs are decoded at reduced scale and PDFs show the largest image on their first
+    page, so even print-resolution files come back quickly as a compact JPEG (PNG if
+    transparent). Vector-only PDF pages can't be previewed.
+    Use this to judge crops, padding or orientation; use inspect_output_image for
+    exact dimensions and DPI."""
+)
+async def preview_image(image_url: str, max_size: int = 512) -> Any:
+    
+    if Image is None:
+        return {"error": "Previews require the Pillow package"}
+    if not 16 <= max_size <= PREVIEW_MAX_SIZE:
+        return {"error": f"max_size must be between 16 and {PREVIEW_MAX_SIZE}"}
+    
+    try:
+        _check_fetch_url(image_url)
+        cache_key = f"{max_size}:{image_url}"
+        cached = await _previews.get(cache_key)
+        if cached:
+            data, mime_type, metadata = cached
+        else:
+            source = await _download_to_spool(image_url, PREVIEW_MAX_SOURCE_BYTES)
+            with source:
+                data, mime_type, metadata = await asyncio.to_thread(_render_preview, source, max_size)
+            await _previews.set(cache_key, (data, mime_type, metadata), PREVIEW_CACHE_TTL_SECONDS)
+        return ToolResult(
+            content=[ImageContent(type="image", data=base64.b64encode(data).decode(), mimeType=mime_type)],
+            structured_content={"success": True, "url": image_url, **metadata, "cache_hit": bool(cached)},
+        )
+    
+    except httpx.HTTPStatusError as e:
+        return {"error": f"Failed to fetch image. Status: {e.response.status_code}"}
+    except Exception as e:
+        return {"error": f"Failed to preview image: {str(e)}"}
+
+
 @mcp.tool(
     title="Validate Mockup SKU",
     description="""Validate a product SKU and retrieve available mockup parameters.
@@ -900,36 +3379,46 @@ async def validate_mockup_sku(sku: str) -> Dict[str, Any]:
         }
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
+        cache_key = f"mockup-sku:{sku}"
+        shared = await _cache.get(cache_key)
+        if shared:
+            status_code, result = shared["status"], shared.get("parameters")
+        else:
+            response = await _hedged_get(
+                "mockup-sku",
                 f"{BASE_URL}/mockup/{sku}",
                 headers={
                     "x-api-key": API_KEY,
                 },
-                timeout=30.0,
+                timeout=_upstream_timeout(30.0),
             )
-            
-            if response.status_code == 200:
-                result = response.json()
-                return {
-                    "success": True,
-                    "sku": sku,
-                    "valid": True,
-                    "parameters": result,
-                    "message": f"SKU {sku} is valid and ready for mockup generation"
-                }
-            elif response.status_code == 404:
-                return {
-                    "success": False,
-                    "sku": sku,
-                    "valid": False,
-                    "error": f"SKU {sku} not found or not available for mockups"
-                }
-            else:
-                return {
-                    "error": f"API request failed with status {response.status_code}",
-                    "details": response.text,
-                }
+            status_code = response.status_code
+            if status_code == 200:
+                result = await _parse_json(response)
+                await _cache.set(cache_key, {"status": 200, "parameters": result}, CATALOG_TTL_SECONDS)
+            elif status_code == 404:
+                await _cache.set(cache_key, {"status": 404}, CATALOG_TTL_SECONDS)
+        
+        if status_code == 200:
+            return {
+                "success": True,
+                "sku": sku,
+                "valid": True,
+                "parameters": result,
+                "message": f"SKU {sku} is valid and ready for mockup generation"
+            }
+        elif status_code == 404:
+            return {
+                "success": False,
+                "sku": sku,
+                "valid": False,
+                "error": f"SKU {sku} not found or not available for mockups"
+            }
+        else:
+            return {
+                "error": f"API request failed with status {status_code}",
+                "details": response.text,
+            }
                 
     except Exception as e:
         return {"error": f"Failed to validate SKU: {str(e)}"}
@@ -952,103 +3441,250 @@ async def validate_mockup_sku(sku: str) -> Dict[str, Any]:
 async def list_available_mockups() -> Dict[str, Any]:
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                "https://blender-mockups-func-dev.azurewebsites.net/api/json",
-                timeout=30.0,
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                return {
-                    "success": True,
-                    "mockups": result,
-                    "total_products": len(result) if isinstance(result, list) else "unknown",
-                    "message": "Successfully retrieved available mockups catalog"
-                }
-            else:
-                return {
-                    "error": f"API request failed with status {response.status_code}",
-                    "details": response.text,
-                }
+        catalog = await _get_mockup_catalog()
+        result = catalog.data
+        return {
+            "success": True,
+            "mockups": result,
+            "total_products": len(result) if isinstance(result, list) else "unknown",
+            "message": "Successfully retrieved available mockups catalog"
+        }
                 
+    except httpx.HTTPStatusError as e:
+        return {
+            "error": f"API request failed with status {e.response.status_code}",
+            "details": e.response.text,
+        }
     except Exception as e:
         return {"error": f"Failed to fetch mockups catalog: {str(e)}"}
 
 
+@mcp.tool(
+    title="Search Mockup Catalog",
+    description="""Search the mockup catalog by SKU, category, camera, color, orientation,
+    finish or product name, without downloading the whole catalog.
+    
+    Parameters:
+    - query: Words to match in product names or SKUs (all must match)
+    - sku, category, camera, color, orientation, finish: Exact filters (case-insensitive)
+    - fields: Entry fields to return (default: sku and name). Use ["*"] for full entries
+    - limit: Maximum results per page (default: 20, max: 100)
+    - cursor: next_cursor from a previous page
+    
+    Returns matching entries, total_matches and next_cursor when more results exist."""
+)
+async def search_mockup_catalog(
+    query: Optional[str] = None,
+    sku: Optional[str] = None,
+    category: Optional[str] = None,
+    camera: Optional[str] = None,
+    color: Optional[str] = None,
+    orientation: Optional[str] = None,
+    finish: Optional[str] = None,
+    fields: Optional[List[str]] = None,
+    limit: int = 20,
+    cursor: Optional[str] = None,
+) -> Dict[str, Any]:
+    
+    try:
+        catalog = await _get_mockup_catalog()
+        
+        offset = 0
+        if cursor:
+            position = _json_loads(base64.urlsafe_b64decode(cursor.encode()))
+            if position.get("v") != catalog.version:
+                return {"error": "The catalog changed since this cursor was issued. Start the search again."}
+            offset = position["o"]
+        
+        filters = {
+            field: value
+            for field, value in (
+                ("sku", sku),
+                ("category", category),
+                ("camera", camera),
+                ("color", color),
+                ("orientation", orientation),
+                ("finish", finish),
+            )
+            if value
+        }
+        matches = catalog.search(filters, query)
+        limit = max(1, min(limit, 100))
+        page = matches[offset:offset + limit]
+        
+        fields = fields or ["sku", "SKU", "name", "title"]
+        results = []
+        for position in page:
+            entry = catalog.entries[position]
+            results.append(entry if "*" in fields else {k: entry[k] for k in fields if k in entry})
+        
+        next_cursor = None
+        if offset + limit < len(matches):
+            next_cursor = base64.urlsafe_b64encode(
+                _json_dumps({"v": catalog.version, "o": offset + limit})
+            ).decode()
+        return {
+            "success": True,
+            "results": results,
+            "total_matches": len(matches),
+            "next_cursor": next_cursor,
+            "catalog_version": catalog.version,
+        }
+                
+    except httpx.HTTPStatusError as e:
+        return {
+            "error": f"API request failed with status {e.response.status_code}",
+            "details": e.response.text,
+        }
+    except Exception as e:
+        return {"error": f"Failed to search mockups catalog: {str(e)}"}
+
+
 @mcp.tool(
     title="Get Product Pixel Dimensions",
     description="""Get pixel dimensions and product details from Prodigi API.
     
     Parameters:
     - sku: Product SKU identifier (e.g., 'GLOBAL-CFP-18X24')
-    - api_key: Prodigi API key for authentication
+    - attributes: (optional) Variant attributes to match, e.g. {"color": "black", "frame": "classic"}
+    - print_area: Print area name (default: 'default'; apparel may use 'front' or 'back')
     
     Returns detailed product information including:
     - Print area pixel dimensions (horizontalResolution, verticalResolution)
+      for the variant matching the given attributes
+    - print_area_options: each distinct pixel size and the attribute values that produce it
     - Physical dimensions and units
     - Available colors, finishes, and variants
     - Shipping regions
     - Product description and attributes
     
+    When variants differ in size, pass attributes so the exact dimensions are returned.
     This is essential for determining the correct pixel dimensions for image preparation."""
 )
-async def get_product_pixel_dimensions(sku: str) -> Dict[str, Any]:
+async def get_product_pixel_dimensions(
+    sku: str,
+    attributes: Optional[Dict[str, str]] = None,
+    print_area: str = "default",
+) -> Dict[str, Any]:
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"https://api.sandbox.prodigi.com/v4.0/products/{sku}",
-                headers={
-                    "X-API-Key": PRODIGI_API_KEY,
-                },
-                timeout=30.0,
+        spec = await _get_product_spec(sku)
+        product = spec.product
+        variants = spec.variants
+        
+        try:
+            positions = spec.find_variants(attributes)
+        except ValueError as e:
+            return {"success": False, "sku": sku, "error": str(e)}
+        
+        options = spec.print_area_options(positions, print_area)
+        pixel_dimensions = None
+        if len(options) == 1:
+            pixel_dimensions = options[0]["pixel_dimensions"]
+        elif not attributes and variants:
+            # Keep the first variant as the default when no attributes narrow it down
+            pixel_dimensions = spec.print_area(0, print_area)
+        
+        result = {
+            "success": True,
+            "sku": sku,
+            "description": product.get("description"),
+            "physical_dimensions": product.get("productDimensions", {}),
+            "pixel_dimensions": pixel_dimensions,
+            "print_area": print_area,
+            "print_area_options": options,
+            "matching_variants": len(positions),
+            "attributes": product.get("attributes", {}),
+            "available_colors": product.get("attributes", {}).get("color", []),
+            "variants_count": len(variants),
+            "product_data": product
+        }
+        if len(options) > 1:
+            result["message"] = (
+                "Pixel dimensions differ between matching variants; "
+                "pass attributes to select one of print_area_options"
             )
-            
-            if response.status_code == 200:
-                result = response.json()
-                product = result.get("product", {})
-                
-                # Extract pixel dimensions from first variant
-                pixel_dimensions = None
-                variants = product.get("variants", [])
-                if variants:
-                    first_variant = variants[0]
-                    print_area_sizes = first_variant.get("printAreaSizes", {})
-                    default_area = print_area_sizes.get("default", {})
-                    if default_area:
-                        pixel_dimensions = {
-                            "width": default_area.get("horizontalResolution"),
-                            "height": default_area.get("verticalResolution")
-                        }
-                
-                return {
-                    "success": True,
-                    "sku": sku,
-                    "description": product.get("description"),
-                    "physical_dimensions": product.get("productDimensions", {}),
-                    "pixel_dimensions": pixel_dimensions,
-                    "attributes": product.get("attributes", {}),
-                    "available_colors": product.get("attributes", {}).get("color", []),
-                    "variants_count": len(variants),
-                    "product_data": product
-                }
-            elif response.status_code == 404:
-                return {
-                    "success": False,
-                    "sku": sku,
-                    "error": f"Product SKU {sku} not found"
-                }
-            else:
-                return {
-                    "error": f"API request failed with status {response.status_code}",
-                    "details": response.text,
-                }
-                
+        return result
+    
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code == 404:
+            return {
+                "success": False,
+                "sku": sku,
+                "error": f"Product SKU {sku} not found"
+            }
+        return {
+            "error": f"API request failed with status {e.response.status_code}",
+            "details": e.response.text,
+        }
     except Exception as e:
         return {"error": f"Failed to get product dimensions: {str(e)}"}
 
 
+@mcp.tool(
+    title="Get Bulk Product Pixel Dimensions",
+    description="""Get pixel dimensions for many Prodigi SKUs in one call.
+    
+    Parameters:
+    - skus: List of product SKU identifiers (duplicates are looked up once)
+    - attributes: (optional) Variant attributes applied to every SKU, e.g. {"color": "black"}
+    - print_area: Print area name (default: 'default')
+    
+    Returns a compact table with one row per unique SKU:
+    [sku, width, height, physical_dimensions, error].
+    Cached SKUs are served from memory and the rest are fetched concurrently."""
+)
+async def get_bulk_product_pixel_dimensions(
+    skus: List[str],
+    attributes: Optional[Dict[str, str]] = None,
+    print_area: str = "default",
+) -> Dict[str, Any]:
+    
+    unique: Dict[str, str] = {}
+    for sku in skus:
+        if sku and sku.strip():
+            unique.setdefault(sku.strip().upper(), sku.strip())
+    unique_skus = list(unique.values())
+    cache_hits = sum(
+        1 for sku in unique_skus
+        if sku.upper() in _product_specs and not _product_specs[sku.upper()].expired
+    )
+    
+    async def row(sku: str) -> List[Any]:
+        try:
+            spec = await _get_product_spec(sku)
+            options = spec.print_area_options(spec.find_variants(attributes), print_area)
+            physical = spec.product.get("productDimensions")
+            if not options:
+                return [sku, None, None, physical, f"No '{print_area}' print area"]
+            if len(options) > 1:
+                return [sku, None, None, physical, "Pixel dimensions vary between variants; pass attributes"]
+            dimensions = options[0]["pixel_dimensions"]
+            return [sku, dimensions["width"], dimensions["height"], physical, None]
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 404:
+                return [sku, None, None, None, "Not found"]
+            return [sku, None, None, None, f"API request failed with status {e.response.status_code}"]
+        except Exception as e:
+            return [sku, None, None, None, str(e)]
+    
+    try:
+        rows = await asyncio.gather(*(row(sku) for sku in unique_skus))
+        
+        return {
+            "success": True,
+            "columns": ["sku", "width", "height", "physical_dimensions", "error"],
+            "rows": rows,
+            "requested": len(skus),
+            "unique": len(unique_skus),
+            "cache_hits": cache_hits,
+            "errors": sum(1 for r in rows if r[4]),
+        }
+    
+    except Exception as e:
+        return {"error": f"Failed to get bulk product dimensions: {str(e)}"}
+
+
 @mcp.tool(
     title="Generate Product Mockup",
     description="""Generate a 3D product mockup using Blender rendering.
@@ -1109,7 +3745,7 @@ async def generate_product_mockup(
         
         request_body = mockup_request.model_dump(exclude_none=True)
         
-        async with httpx.AsyncClient() as client:
+        async with _upstream_client() as client:
             response = await client.post(
                 f"{BASE_URL}/mockup",
                 json=request_body,
@@ -1117,11 +3753,11 @@ async def generate_product_mockup(
                     "x-api-key": API_KEY,
                     "Content-Type": "application/json",
                 },
-                timeout=60.0,  # Mockups may take longer
+                timeout=_upstream_timeout(60.0),  # Mockups may take longer
             )
             
             if response.status_code == 200:
-                result = response.json()
+                result = await _parse_json(response)
                 return {
                     "success": True,
                     "result": result,
@@ -1142,6 +3778,27 @@ async def generate_product_mockup(
         return {"error": f"Failed to generate mockup: {str(e)}"}
 
 
+# Porcus Lardum OpenAPI schema, refreshed after SCHEMA_TTL_SECONDS
+_openapi_schema: Optional[Dict[str, Any]] = None
+_openapi_schema_fetched_at = 0.0
+
+
+async def _get_openapi_schema() -> Dict[str, Any]:
+    global _openapi_schema, _openapi_schema_fetched_at
+    if _openapi_schema is not None and time.monotonic() - _openapi_schema_fetched_at < SCHEMA_TTL_SECONDS:
+        return _openapi_schema
+    shared = await _cache.get("openapi-schema")
+    if shared:
+        _openapi_schema, _openapi_schema_fetched_at = shared["schema"], _monotonic_since(shared["fetched_at"])
+        return _openapi_schema
+    response = await _hedged_get("openapi-schema", f"{BASE_URL}/openapi.json", timeout=_upstream_timeout(30.0))
+    response.raise_for_status()
+    _openapi_schema = await _parse_json(response)
+    _openapi_schema_fetched_at = time.monotonic()
+    await _cache.set("openapi-schema", {"schema": _openapi_schema, "fetched_at": time.time()}, SCHEMA_TTL_SECONDS)
+    return _openapi_schema
+
+
 @mcp.tool(
     title="Get OpenAPI Schema",
     description="""Fetch the complete OpenAPI schema from Porcus Lardum API to aid with code generation.
@@ -1153,28 +3810,750 @@ async def generate_product_mockup(
 async def get_openapi_schema() -> Dict[str, Any]:
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{BASE_URL}/openapi.json",
-                timeout=30.0,
-            )
-            
-            if response.status_code == 200:
-                return response.json()
-            else:
-                return {
-                    "error": f"Failed to fetch OpenAPI schema. Status: {response.status_code}",
-                    "details": response.text,
-                }
-                
+        return await _get_openapi_schema()
+    
+    except httpx.HTTPStatusError as e:
+        return {
+            "error": f"Failed to fetch OpenAPI schema. Status: {e.response.status_code}",
+            "details": e.response.text,
+        }
     except Exception as e:
         return {"error": f"Failed to fetch OpenAPI schema: {str(e)}"}
 
-app = mcp.http_app(transport="streamable-http")
+# Current content version of the most recently read resources, by URI
+_resource_versions: "OrderedDict[str, str]" = OrderedDict()
+# Resource versions each MCP session last read, so it can be told when one changes
+_resource_readers: "OrderedDict[str, Dict[str, str]]" = OrderedDict()
+
+
+def _resource_document(uri: str, data: Any, fetched_at: float, version: Optional[str] = None) -> str:
+    """Wraps resource data with its version (a content hash, usable as an ETag) and fetch time."""
+    version = version or hashlib.sha256(_json_dumps(data)).hexdigest()[:16]
+    previous = _resource_versions.get(uri)
+    if previous and previous != version:
+        logger.info("resource %s changed", uri, extra={"fields": {"event": "resource_changed", "uri": uri, "version": version}})
+    _resource_versions[uri] = version
+    _resource_versions.move_to_end(uri)
+    while len(_resource_versions) > RESOURCE_VERSIONS_MAX:
+        _resource_versions.popitem(last=False)
+    fetched = datetime.fromtimestamp(time.time() - (time.monotonic() - fetched_at), timezone.utc)
+    return _json_dumps({"uri": uri, "version": version, "fetched_at": fetched.isoformat(), "data": data}).decode()
+
+
+@mcp.resource(
+    "mockup://catalog",
+    name="Mockup catalog",
+    description="Every product available for mockups, as returned by list_available_mockups",
+    mime_type="application/json",
+)
+async def mockup_catalog_resource() -> str:
+    catalog = await _get_mockup_catalog()
+    return _resource_document("mockup://catalog", catalog.data, catalog.fetched_at, catalog.version)
+
+
+@mcp.resource(
+    "mockup://sku/{sku}",
+    name="Mockup SKU parameters",
+    description="Camera angles, colors and other mockup options for one SKU, as returned by validate_mockup_sku",
+    mime_type="application/json",
+)
+async def mockup_sku_resource(sku: str) -> str:
+    result = await _tool_fn(validate_mockup_sku)(sku)
+    if not result.get("valid"):
+        raise ResourceError(result.get("error") or f"SKU {sku} not found")
+    return _resource_document(f"mockup://sku/{sku}", result["parameters"], time.monotonic())
+
+
+@mcp.resource(
+    "prodigi://product/{sku}",
+    name="Prodigi product",
+    description="Prodigi product details, variants and print areas for one SKU",
+    mime_type="application/json",
+)
+async def prodigi_product_resource(sku: str) -> str:
+    try:
+        spec = await _get_product_spec(sku)
+    except httpx.HTTPStatusError as e:
+        raise ResourceError(f"Product SKU {sku} not found" if e.response.status_code == 404 else str(e)) from e
+    return _resource_document(f"prodigi://product/{sku}", spec.product, spec.fetched_at)
+
+
+@mcp.resource(
+    "porcus-lardum://openapi",
+    name="Porcus Lardum OpenAPI schema",
+    description="The Porcus Lardum API's OpenAPI specification",
+    mime_type="application/json",
+)
+async def openapi_schema_resource() -> str:
+    schema = await _get_openapi_schema()
+    return _resource_document("porcus-lardum://openapi", schema, _openapi_schema_fetched_at)
+
+
+_RESOURCE_READERS = [
+    (re.compile(r"mockup://catalog$"), mockup_catalog_resource),
+    (re.compile(r"mockup://sku/(.+)$"), mockup_sku_resource),
+    (re.compile(r"prodigi://product/(.+)$"), prodigi_product_resource),
+    (re.compile(r"porcus-lardum://openapi$"), openapi_schema_resource),
+]
+
+
+async def _refresh_resources() -> None:
+    """Re-reads every resource a tracked session has read, every RESOURCE_REFRESH_SECONDS.
+    
+    Each read refetches upstream once the server-side cache entry has expired, so
+    changes show up in `_resource_versions` without waiting for the next client read.
+    """
+    while True:
+        await asyncio.sleep(RESOURCE_REFRESH_SECONDS)
+        uris = {uri for seen in list(_resource_readers.values()) for uri in seen}
+        for uri in uris:
+            for pattern, read in _RESOURCE_READERS:
+                match = pattern.match(uri)
+                if not match:
+                    continue
+                try:
+                    await _tool_fn(read)(*match.groups())
+                except Exception as e:
+                    logger.warning("Resource refresh failed for %s: %s", uri, e)
+
+
+class ResourceNotificationMiddleware(Middleware):
+    """Sends notifications/resources/updated for resources that changed since the session read them.
+    
+    The notification rides on the session's next request. Only sessions that carry an
+    Mcp-Session-Id across requests are tracked, so it is only installed without
+    STATELESS_HTTP.
+    """
+
+    @staticmethod
+    def _session(context: MiddlewareContext) -> Optional[str]:
+        ctx = context.fastmcp_context
+        if ctx is None:
+            return None
+        try:
+            if "mcp-session-id" not in get_http_request().headers:
+                return None
+        except RuntimeError:
+            pass
+        try:
+            return ctx.session_id
+        except ValueError:
+            return None
+
+    async def on_request(self, context: MiddlewareContext, call_next):
+        ctx = context.fastmcp_context
+        session = self._session(context)
+        seen = _resource_readers.get(session) if session else None
+        if seen:
+            for uri, version in list(seen.items()):
+                current = _resource_versions.get(uri, version)
+                if current == version:
+                    continue
+                seen[uri] = current
+                notification = ResourceUpdatedNotification(
+                    method="notifications/resources/updated", params=ResourceUpdatedNotificationParams(uri=uri)
+                )
+                with contextlib.suppress(Exception):
+                    await ctx.session.send_notification(ServerNotification(notification), related_request_id=ctx.request_id)
+        return await call_next(context)
+
+    async def on_read_resource(self, context: MiddlewareContext, call_next):
+        result = await call_next(context)
+        uri = str(context.message.uri)
+        session = self._session(context)
+        if uri in _resource_versions and session:
+            _resource_readers.setdefault(session, {})[uri] = _resource_versions[uri]
+            _resource_readers.move_to_end(session)
+            while len(_resource_readers) > RESOURCE_READERS_MAX:
+                _resource_readers.popitem(last=False)
+        return result
+
+
+# Warmup results for the current instance, and warmup jobs still running past the budget
+_warmup_status: Dict[str, Any] = {}
+_warmup_tasks: set = set()
+# Loops started with the server (resource refresh, loop lag monitor), cancelled on shutdown
+_background_tasks: List[asyncio.Task] = []
+
+
+def _upstream_origins() -> List[str]:
+    return list(dict.fromkeys(
+        "/".join(url.split("/", 3)[:3]) for url in (BASE_URL, MOCKUP_CATALOG_URL, PRODIGI_BASE_URL)
+    ))
+
+
+async def _open_connection(origin: str) -> None:
+    # Any response will do; the point is the TCP and TLS handshake left in the pool
+    await _http_client().head(origin, timeout=WARMUP_BUDGET_SECONDS)
+
+
+def _finish_warmup_job(task: asyncio.Task) -> None:
+    _warmup_tasks.discard(task)
+    name = task.get_name()
+    if task.cancelled():
+        _warmup_status["failed"][name] = "cancelled"
+    elif task.exception() is not None:
+        _warmup_status["failed"][name] = str(task.exception()) or type(task.exception()).__name__
+    else:
+        _warmup_status["completed"].append(name)
+    if name in _warmup_status["pending"]:
+        _warmup_status["pending"].remove(name)
+
+
+async def _warmup() -> Dict[str, Any]:
+    """Opens upstream connections and prefetches the catalog, OpenAPI schema and WARMUP_SKUS.
+    
+    Returns after at most WARMUP_BUDGET_SECONDS; jobs still running then finish in the background.
+    """
+    jobs = {f"connect {origin}": _open_connection(origin) for origin in _upstream_origins()}
+    jobs["mockup catalog"] = _get_mockup_catalog()
+    jobs["openapi schema"] = _get_openapi_schema()
+    for sku in WARMUP_SKUS:
+        jobs[f"product {sku}"] = _get_product_spec(sku)
+    
+    started = time.monotonic()
+    _warmup_status.update({"completed": [], "failed": {}, "pending": list(jobs)})
+    for name, job in jobs.items():
+        task = asyncio.ensure_future(job)
+        task.set_name(name)
+        task.add_done_callback(_finish_warmup_job)
+        _warmup_tasks.add(task)
+    await asyncio.wait(set(_warmup_tasks), timeout=WARMUP_BUDGET_SECONDS)
+    _warmup_status["elapsed_seconds"] = round(time.monotonic() - started, 3)
+    return _warmup_status
+
+
+class WarmupMiddleware:
+    """Runs the startup warmup before the ASGI lifespan reports ready and starts the background
+    loops; on shutdown, stops them and closes the shared client."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "lifespan":
+            return await self.app(scope, receive, send)
+        
+        async def send_after_lifespan(message):
+            if message["type"] == "lifespan.startup.complete":
+                if WARMUP_ENABLED:
+                    await _warmup()
+                # Resources are only refreshed for sessions that can be notified
+                loops = [_monitor_loop_lag] if STATELESS_HTTP else [_refresh_resources, _monitor_loop_lag]
+                _background_tasks.extend(asyncio.ensure_future(loop()) for loop in loops)
+            elif message["type"] == "lifespan.shutdown.complete":
+                for task in [*_warmup_tasks, *_background_tasks]:
+                    task.cancel()
+                _background_tasks.clear()
+                await _close_http_client()
+            await send(message)
+        return await self.app(scope, receive, send_after_lifespan)
+
+
+# In-flight tool call tasks, counted by /healthz
+_inflight_calls: Set[asyncio.Task] = set()
+# ASGI scope key holding the tool call tasks served by one HTTP request
+_SCOPE_CALLS = "porcus_lardum.calls"
+
+
+class ToolCallCancelled(ToolError):
+    """Raised by DeadlineMiddleware when a tool call's task is cancelled, e.g. on disconnect."""
+
+
+def _job_ids(result: Dict[str, Any]) -> List[str]:
+    jobs = [result, *(job for job in result.get("jobs", []) if isinstance(job, dict))]
+    return [job["transform_job_id"] for job in jobs if job.get("transform_job_id")]
+
+
+class AccessLogMiddleware(Middleware):
+    """Logs one structured record per tool call: tool, status, duration, upstream calls,
+    job ids and payload sizes. Successful calls are sampled per LOG_SAMPLE_RATES."""
+
+    async def on_call_tool(self, context: MiddlewareContext, call_next):
+        upstream: List[Dict[str, Any]] = []
+        token = _call_upstream.set(upstream)
+        started = time.monotonic()
+        status, result, error = "ok", None, None
+        try:
+            result = await call_next(context)
+            return result
+        except (ToolCallCancelled, asyncio.CancelledError):
+            status = "cancelled"
+            raise
+        except ToolError as e:
+            status, error = "error", str(e)
+            raise
+        except Exception as e:
+            status, error = "exception", str(e)
+            raise
+        finally:
+            structured = getattr(result, "structured_content", None) or {}
+            if status == "ok" and (structured.get("error") or getattr(result, "is_error", False)):
+                status, error = "error", structured.get("error")
+            if status != "ok" or random.random() < LOG_SAMPLE_RATES.get(context.message.name, 1.0):
+                fields = {
+                    "event": "tool_call",
+                    "tool": context.message.name,
+                    "status": status,
+                    "duration_ms": round((time.monotonic() - started) * 1000, 1),
+                    "upstream": upstream,
+                    "job_ids": _job_ids(structured),
+                    "cache_hit": structured.get("cache_hit"),
+                    "argument_bytes": len(_json_dumps(context.message.arguments or {})),
+                    "result_bytes": sum(
+                        len(getattr(block, "text", None) or getattr(block, "data", None) or "")
+                        for block in getattr(result, "content", None) or []
+                    ),
+                }
+                if error:
+                    fields["error"] = error
+                logger.info("tool call %s %s", context.message.name, status, extra={"fields": fields})
+            _call_upstream.reset(token)
+
+
+class DeadlineMiddleware(Middleware):
+    """Runs each tool call in its own task under a deadline, so it can be cancelled cleanly.
+    
+    The deadline is TOOL_CALL_TIMEOUT_SECONDS, or the client's `_meta.timeout_seconds` if shorter.
+    Upstream requests made by the tool read the remaining time through `_upstream_timeout`.
+    """
+
+    @staticmethod
+    def _requested_timeout(context: MiddlewareContext) -> Any:
+        meta = getattr(context.message, "meta", None)
+        if meta is None and context.fastmcp_context is not None:
+            try:
+                meta = context.fastmcp_context.request_context.meta
+            except ValueError:
+                return None
+        return getattr(meta, "timeout_seconds", None)
+
+    async def on_call_tool(self, context: MiddlewareContext, call_next):
+        timeout = TOOL_CALL_TIMEOUT_SECONDS
+        requested = self._requested_timeout(context)
+        if isinstance(requested, (int, float)) and requested > 0:
+            timeout = min(timeout, float(requested))
+        deadline = time.monotonic() + timeout
+        
+        async def run():
+            _call_deadline.set(deadline)
+            return await call_next(context)
+        
+        call = asyncio.ensure_future(run())
+        try:
+            scope = get_http_request().scope
+        except RuntimeError:
+            scope = {}
+        calls = scope.get(_SCOPE_CALLS)
+        if calls is not None:
+            calls.add(call)
+        _inflight_calls.add(call)
+        
+        try:
+            done, _ = await asyncio.wait({call}, timeout=timeout)
+        except asyncio.CancelledError:
+            call.cancel()
+            raise
+        finally:
+            if calls is not None:
+                calls.discard(call)
+            _inflight_calls.discard(call)
+        
+        if not done:
+            call.cancel()
+            raise ToolError(f"Tool call exceeded its {timeout:g}s deadline")
+        if call.cancelled():
+            raise ToolCallCancelled("Tool call cancelled")
+        return call.result()
+
+
+class CancellationMiddleware:
+    """Cancels the tool calls of an HTTP request when its client disconnects.
+    
+    Hosts that only report the disconnect after the response is sent, such as the Azure
+    Functions ASGI adapter, get no early cancellation; there the tool call deadline applies.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"].rstrip("/") != MCP_PATH:
+            return await self.app(scope, receive, send)
+        
+        messages = []
+        while True:
+            message = await receive()
+            messages.append(message)
+            if message["type"] != "http.request" or not message.get("more_body", False):
+                break
+        
+        calls = scope[_SCOPE_CALLS] = set()
+        disconnected = asyncio.Event()
+        
+        async def replay():
+            if messages:
+                return messages.pop(0)
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+        
+        async def watch_disconnect():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+            disconnected.set()
+            for call in list(calls):
+                call.cancel()
+        
+        watcher = asyncio.ensure_future(watch_disconnect())
+        try:
+            await self.app(scope, replay, send)
+        finally:
+            watcher.cancel()
+
+
+# Profiles of single requests, newest last, served from /profiles/{id} while profiling is on
+_profiles: "OrderedDict[str, Tuple[str, str, bytes]]" = OrderedDict()
+_profiling_active = False
+
+
+def _profile_token_matches(scope) -> bool:
+    token = dict(scope.get("headers") or []).get(b"x-profile-token")
+    return bool(token) and hmac.compare_digest(token, PROFILING_TOKEN.encode())
+
+
+def _start_profiler():
+    if Profiler is not None:
+        # Profiles the whole event loop thread: the tool call itself runs in another task
+        profiler = Profiler(async_mode="disabled")
+        profiler.start()
+        return profiler
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def _stop_profiler(profiler) -> Tuple[str, str, bytes]:
+    """Returns (content type, file extension, data) for the finished profile."""
+    if Profiler is not None:
+        profiler.stop()
+        return "application/json", "speedscope.json", SpeedscopeRenderer().render(profiler.last_session).encode()
+    profiler.disable()
+    # Same format as pstats.Stats.dump_stats, loadable with pstats or snakeviz
+    return "application/octet-stream", "pstats", marshal.dumps(pstats.Stats(profiler).stats)
+
+
+class ProfilingMiddleware:
+    """Profiles a request carrying an `X-Profile-Token` header that matches MCP_PROFILING_TOKEN.
+    
+    The response gets an `X-Profile-Url` header pointing at the profile, a speedscope file
+    when pyinstrument is installed and a pstats dump otherwise. One request is profiled at a
+    time; others on the same instance show up in it, since they share the event loop.
+    Only installed when MCP_PROFILING_TOKEN is set.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        global _profiling_active
+        if scope["type"] != "http" or _profiling_active or not _profile_token_matches(scope):
+            return await self.app(scope, receive, send)
+        
+        profile_id = uuid.uuid4().hex
+        
+        async def send_with_profile_url(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"x-profile-url", f"/profiles/{profile_id}".encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+        
+        _profiling_active = True
+        profiler = _start_profiler()
+        try:
+            await self.app(scope, receive, send_with_profile_url)
+        finally:
+            _profiles[profile_id] = _stop_profiler(profiler)
+            _profiling_active = False
+            while len(_profiles) > PROFILES_MAX_STORED:
+                _profiles.popitem(last=False)
+
+
+if PROFILING_TOKEN:
+    @mcp.custom_route("/profiles/{profile_id}", methods=["GET"])
+    async def download_profile(request: Request) -> Response:
+        if not _profile_token_matches(request.scope):
+            return JSONResponse({"error": "Missing or invalid X-Profile-Token header"}, status_code=403)
+        profile = _profiles.get(request.path_params["profile_id"])
+        if profile is None:
+            return JSONResponse({"error": "Profile not found"}, status_code=404)
+        content_type, extension, data = profile
+        return Response(
+            data,
+            media_type=content_type,
+            headers={"content-disposition": f'attachment; filename="{request.path_params["profile_id"]}.{extension}"'},
+        )
+
+
+@mcp.custom_route("/metrics", methods=["GET"])
+async def metrics(request: Request) -> Response:
+    if not _health_token_matches(request.scope):
+        return JSONResponse({"error": "Missing or invalid X-Health-Token header"}, status_code=403)
+    return JSONResponse({
+        "hedging": {
+            "enabled": HEDGING_ENABLED,
+            "endpoints": {endpoint: stats.metrics() for endpoint, stats in _endpoint_stats.items()},
+        },
+    })
+
+
+# Recent event loop lag samples, in seconds, taken every LOOP_LAG_INTERVAL_SECONDS
+_loop_lag_samples: deque = deque(maxlen=120)
+
+
+async def _monitor_loop_lag() -> None:
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(LOOP_LAG_INTERVAL_SECONDS)
+        _loop_lag_samples.append(max(0.0, time.monotonic() - started - LOOP_LAG_INTERVAL_SECONDS))
+
+
+def _pool_usage() -> Dict[str, Any]:
+    in_flight = _upstream_transport.in_flight if _upstream_transport is not None else 0
+    return {
+        "max_connections": UPSTREAM_MAX_CONNECTIONS,
+        "in_use": min(in_flight, UPSTREAM_MAX_CONNECTIONS),
+        "queued": max(0, in_flight - UPSTREAM_MAX_CONNECTIONS),
+    }
+
+
+def _health() -> Dict[str, Any]:
+    """Collects the saturation signals reported by /healthz and judged by /readyz."""
+    recent_lag = list(_loop_lag_samples)[-10:]
+    hosts = {
+        host: {
+            "limit": semaphore.limit,
+            "in_use": semaphore.in_use,
+            "waiting": semaphore.waiting,
+        }
+        for host, semaphore in _host_semaphores.items()
+    }
+    return {
+        "loop_lag_ms": {
+            "last": round(recent_lag[-1] * 1000, 1) if recent_lag else None,
+            "recent_max": round(max(recent_lag) * 1000, 1) if recent_lag else None,
+            "window_max": round(max(_loop_lag_samples) * 1000, 1) if _loop_lag_samples else None,
+        },
+        "inflight_tool_calls": len(_inflight_calls),
+        "upstream_pool": _pool_usage(),
+        "upstream_hosts": hosts,
+        "hedging": {endpoint: stats.metrics() for endpoint, stats in _endpoint_stats.items()} if HEDGING_ENABLED else None,
+        "caches": {
+            "backend": type(_cache).__name__,
+            "mockup_catalog": bool(_mockup_catalog and not _mockup_catalog.expired),
+            "openapi_schema": _openapi_schema is not None
+            and time.monotonic() - _openapi_schema_fetched_at < SCHEMA_TTL_SECONDS,
+            "product_specs": sum(1 for spec in _product_specs.values() if not spec.expired),
+            "previews": len(_previews.entries),
+            "warmup": _warmup_status or None,
+        },
+        "logging": {"queued": _log_queue.qsize(), "dropped": _DroppingQueueHandler.dropped},
+    }
+
+
+def _unready_reasons(health: Dict[str, Any]) -> List[str]:
+    reasons = []
+    lag = health["loop_lag_ms"]["recent_max"]
+    if lag is not None and lag > READY_MAX_LOOP_LAG_MS:
+        reasons.append(f"event loop lag {lag} ms exceeds {READY_MAX_LOOP_LAG_MS} ms")
+    if health["inflight_tool_calls"] > READY_MAX_INFLIGHT_CALLS:
+        reasons.append(f"{health['inflight_tool_calls']} tool calls in flight exceeds {READY_MAX_INFLIGHT_CALLS}")
+    pool = health["upstream_pool"]
+    utilization = pool["in_use"] / pool["max_connections"]
+    if utilization > READY_MAX_POOL_UTILIZATION:
+        reasons.append(f"upstream pool {utilization:.0%} in use exceeds {READY_MAX_POOL_UTILIZATION:.0%}")
+    waiting = pool["queued"] + sum(host["waiting"] for host in health["upstream_hosts"].values())
+    if waiting > READY_MAX_UPSTREAM_WAITING:
+        reasons.append(f"{waiting} upstream requests waiting exceeds {READY_MAX_UPSTREAM_WAITING}")
+    return reasons
+
+
+def _health_token_matches(scope) -> bool:
+    token = dict(scope.get("headers") or []).get(b"x-health-token")
+    return bool(HEALTH_TOKEN and token) and hmac.compare_digest(token, HEALTH_TOKEN.encode())
+
+
+@mcp.custom_route("/healthz", methods=["GET"])
+async def healthz(request: Request) -> Response:
+    # Answering at all shows the event loop is alive; the details are for diagnosis only
+    details = _health() if _health_token_matches(request.scope) else {}
+    return JSONResponse({"status": "ok", **details})
+
+
+@mcp.custom_route("/readyz", methods=["GET"])
+async def readyz(request: Request) -> Response:
+    health = _health()
+    reasons = _unready_reasons(health)
+    details = health if _health_token_matches(request.scope) else {}
+    return JSONResponse(
+        {"ready": not reasons, "reasons": reasons, **details},
+        status_code=503 if reasons else 200,
+        headers={"Cache-Control": "no-store"},
+    )
+
+
+# Encodings we can produce, in order of preference when the client rates them equally
+_RESPONSE_ENCODINGS = [
+    encoding for encoding, available in (("zstd", zstandard), ("br", brotli), ("gzip", True)) if available
+]
+_COMPRESSIBLE_TYPES = (b"application/json", b"text/", b"application/xml", b"application/javascript")
+
+
+def _negotiate_encoding(accept_encoding: bytes) -> Optional[str]:
+    accepted: Dict[str, float] = {}
+    for item in accept_encoding.decode("latin-1").lower().split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                continue
+        accepted[name.strip()] = quality
+    best = None
+    for encoding in _RESPONSE_ENCODINGS:
+        quality = accepted.get(encoding, accepted.get("*", 0.0))
+        if quality > 0 and (best is None or quality > best[1]):
+            best = (encoding, quality)
+    return best[0] if best else None
+
+
+def _compressor(encoding: str):
+    """Returns (compress, finish) functions; `compress` flushes, so each chunk can be sent at once."""
+    if encoding == "zstd":
+        zstd = zstandard.ZstdCompressor(level=3).compressobj()
+        return lambda data: zstd.compress(data) + zstd.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK), zstd.flush
+    if encoding == "br":
+        br = brotli.Compressor(quality=4)
+        return lambda data: br.process(data) + br.flush(), br.finish
+    gzip = zlib.compressobj(6, zlib.DEFLATED, 31)
+    return lambda data: gzip.compress(data) + gzip.flush(zlib.Z_SYNC_FLUSH), gzip.flush
+
+
+class CompressionMiddleware:
+    """Compresses JSON and text responses with the best encoding the client accepts (zstd, br, gzip).
+    
+    Complete bodies under COMPRESSION_MIN_BYTES are sent as-is. Streamed responses such as
+    the SSE transport are compressed chunk by chunk and flushed after each one, so events
+    are never held back.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        encoding = _negotiate_encoding(dict(scope["headers"]).get(b"accept-encoding", b""))
+        if encoding is None:
+            return await self.app(scope, receive, send)
+        
+        start = None
+        compress = finish = None
+        
+        async def send_compressed(message):
+            nonlocal start, compress, finish
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if start is not None:
+                headers = start.get("headers", [])
+                if message["type"] == "http.response.body" and self._should_compress(start, message):
+                    compress, finish = _compressor(encoding)
+                    headers = [(k, v) for k, v in headers if k.lower() != b"content-length"]
+                    headers += [(b"content-encoding", encoding.encode()), (b"vary", b"Accept-Encoding")]
+                await send({**start, "headers": headers})
+                start = None
+            if compress is None or message["type"] != "http.response.body":
+                return await send(message)
+            
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if len(body) > JSON_OFFLOAD_THRESHOLD:
+                # zlib, brotli and zstd release the GIL on large inputs
+                body = await asyncio.to_thread(compress, body)
+            elif body:
+                body = compress(body)
+            if not more_body:
+                body += finish()
+            await send({"type": "http.response.body", "body": body, "more_body": more_body})
+        
+        await self.app(scope, receive, send_compressed)
+
+    @staticmethod
+    def _should_compress(start, message) -> bool:
+        if start["status"] < 200 or start["status"] in (204, 304):
+            return False
+        headers = dict((k.lower(), v) for k, v in start.get("headers", []))
+        if b"content-encoding" in headers:
+            return False
+        if not headers.get(b"content-type", b"").startswith(_COMPRESSIBLE_TYPES):
+            return False
+        return message.get("more_body", False) or len(message.get("body", b"")) >= COMPRESSION_MIN_BYTES
+
+
+def _summary(description: Optional[str]) -> Optional[str]:
+    if not description:
+        return description
+    return " ".join(description.strip().split("\n\n")[0].split())
+
+
+class ManifestCacheMiddleware(Middleware):
+    """Reuses the tool and prompt components resolved by the first tools/list and prompts/list.
+    
+    Only component resolution (and, in compact mode, cutting descriptions to their first
+    paragraph) is cached; FastMCP still converts and serializes the listing on every request.
+    Tools and prompts are only registered at import, so the cached components never go stale.
+    """
+
+    def __init__(self):
+        self.listings: Dict[str, list] = {}
+
+    async def _listing(self, context: MiddlewareContext, call_next) -> list:
+        if context.method not in self.listings:
+            components = await call_next(context)
+            if COMPACT_MANIFEST:
+                components = [
+                    component.model_copy(update={"description": _summary(component.description)})
+                    for component in components
+                ]
+            self.listings[context.method] = components
+        return self.listings[context.method]
+
+    async def on_list_tools(self, context: MiddlewareContext, call_next):
+        return await self._listing(context, call_next)
+
+    async def on_list_prompts(self, context: MiddlewareContext, call_next):
+        return await self._listing(context, call_next)
+
+
+mcp.add_middleware(AccessLogMiddleware())
+mcp.add_middleware(DeadlineMiddleware())
+if not STATELESS_HTTP:
+    mcp.add_middleware(ResourceNotificationMiddleware())
+mcp.add_middleware(ManifestCacheMiddleware())
+
+app = mcp.http_app(path=MCP_PATH, transport="streamable-http")
+
+app.add_middleware(CancellationMiddleware)
+app.add_middleware(WarmupMiddleware)
+if PROFILING_TOKEN:
+    app.add_middleware(ProfilingMiddleware)
+app.add_middleware(CompressionMiddleware)
 
 app.add_middleware(
     CORSMiddleware,
-    expose_headers=["mcp-session-id"]
+    expose_headers=["mcp-session-id", "x-profile-url"]
 )
 
 if __name__ == "__main__":
@@ -0,0 +1,62 @@
+import asyncio
+
+import pytest
+import redis
+
+import server
+
+
+class UnreachableRedis:
+    async def get(self, key):
+        raise redis.ConnectionError("unreachable")
+
+    async def set(self, key, value, px=None, nx=False):
+        raise redis.ConnectionError("unreachable")
+
+    async def delete(self, key):
+        raise redis.ConnectionError("unreachable")
+
+
+def test_unreachable_redis_refuses_locks():
+    cache = server.RedisCache(UnreachableRedis())
+    assert asyncio.run(cache.set_if_absent("lock", True, 30)) is False
+
+
+def test_unreachable_redis_falls_back_to_memory():
+    cache = server.RedisCache(UnreachableRedis())
+    
+    async def roundtrip():
+        await cache.set("key", {"value": 1}, 30)
+        stored = await cache.get("key")
+        await cache.delete("key")
+        return stored, await cache.get("key")
+    
+    assert asyncio.run(roundtrip()) == ({"value": 1}, None)
+
+
+def test_redis_cache_against_fakeredis(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    # Encode and decode the large value in a worker thread
+    monkeypatch.setattr(server, "JSON_OFFLOAD_THRESHOLD", 1024)
+    client = fakeredis.aioredis.FakeRedis()
+    cache = server.RedisCache(client, prefix="test:")
+    large = {"values": ["x" * 100] * 100}
+    
+    async def exercise():
+        await cache.set("large", large, 30)
+        stored = await client.get("test:large")
+        first = await cache.set_if_absent("lock", True, 0.05)
+        second = await cache.set_if_absent("lock", True, 0.05)
+        await asyncio.sleep(0.1)
+        after_expiry = await cache.set_if_absent("lock", True, 0.05)
+        return stored, await cache.get("large"), first, second, after_expiry
+    
+    stored, roundtrip, first, second, after_expiry = asyncio.run(exercise())
+    assert stored[:1] == b"z" and len(stored) < len(server._json_dumps(large))
+    assert roundtrip == large
+    assert (first, second, after_expiry) == (True, False, True)
+
+
+def test_cache_backend_is_abstract():
+    with pytest.raises(TypeError):
+        server.CacheBackend()
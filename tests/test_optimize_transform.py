@@ -0,0 +1,90 @@
+import asyncio
+import inspect
+
+import pytest
+
+import server
+from server import ImageOpsTransformParamsIn, _optimize_transform
+
+
+def optimize(chain, **ops):
+    params, changes = _optimize_transform(ImageOpsTransformParamsIn(image_ops=True, transforms_array=chain, **ops))
+    return params.model_dump(exclude_none=True).get("transforms_array", []), changes
+
+
+def planned_size(params, source=(1000, 500)):
+    plan = asyncio.run(server._plan_for_source(params, source_width=source[0], source_height=source[1]))
+    return plan["result"]["width"], plan["result"]["height"]
+
+
+@pytest.mark.parametrize(
+    "chain, source",
+    [
+        ([{"rotate": 30}, {"rotate": 330}], (1000, 500)),
+        ([{"rotate": 45}, {"rotate": 45}], (1000, 500)),
+        ([{"rotate": 90}, {"rotate": 30}], (1000, 500)),
+        ([{"grayscale": True}, {"transparency_to_color": [255, 0, 0]}, {"grayscale": True}], (1000, 500)),
+        ([{"crop": [{"pixels": 10}]}, {"crop": [{"pixels": 5}]}, {"rotate": 90}, {"rotate": 180}], (1000, 500)),
+        (
+            [{"contain": [{"pixels": 100}, {"pixels": 100}]}, {"contain": [{"pixels": 1000}, {"pixels": 1000}]}],
+            (1000, 333),
+        ),
+    ],
+)
+def test_optimized_chain_plans_the_same_size(chain, source):
+    params = ImageOpsTransformParamsIn(image_ops=True, transforms_array=chain)
+    optimized, _ = _optimize_transform(params)
+    assert planned_size(optimized, source) == planned_size(params, source)
+
+
+def test_folds_right_angle_rotations():
+    assert optimize([{"rotate": 90}, {"rotate": 180}])[0] == [{"rotate": 270}]
+    assert optimize([{"rotate": 90}, {"rotate": 270}])[0] == []
+
+
+def test_keeps_other_rotations_apart():
+    assert optimize([{"rotate": 30}, {"rotate": 330}])[0] == [{"rotate": 30}, {"rotate": 330}]
+    assert optimize([{"rotate": 90}, {"rotate": 45}])[0] == [{"rotate": 90}, {"rotate": 45}]
+
+
+def test_drops_only_back_to_back_grayscale():
+    chain, changes = optimize([{"grayscale": True}, {"grayscale": True}])
+    assert chain == [{"grayscale": True}]
+    assert changes == ["transforms_array[1]: dropped repeated grayscale"]
+    
+    separated = [{"grayscale": True}, {"transparency_to_color": [255, 0, 0]}, {"grayscale": True}]
+    assert optimize(separated)[0] == separated
+
+
+def test_keeps_chain_grayscale_after_top_level_grayscale():
+    assert optimize([{"grayscale": True}], grayscale=True)[0] == [{"grayscale": True}]
+
+
+def test_merges_consecutive_crops():
+    chain, _ = optimize([{"crop": [{"pixels": 10}]}, {"crop": [{"pixels": 5}]}])
+    assert chain == [{"crop": [{"pixels": 15}] * 4}]
+
+
+def test_merges_crop_box_inside_the_first():
+    chain, _ = optimize([
+        {"crop_box": [[{"pixels": 400}, {"pixels": 300}], [{"pixels": 10}, {"pixels": 20}]]},
+        {"crop_box": [[{"pixels": 100}, {"pixels": 100}], [{"pixels": 50}, {"pixels": 50}]]},
+    ])
+    assert chain == [{"crop_box": [[{"pixels": 100}, {"pixels": 100}], [{"pixels": 60}, {"pixels": 70}]]}]
+
+
+def test_keeps_crop_box_outside_the_first():
+    chain = [
+        {"crop_box": [[{"pixels": 100}, {"pixels": 100}]]},
+        {"crop_box": [[{"pixels": 200}, {"pixels": 200}]]},
+    ]
+    assert optimize(chain)[0] == chain
+    params = ImageOpsTransformParamsIn(image_ops=True, transforms_array=chain)
+    plan = asyncio.run(server._plan_for_source(_optimize_transform(params)[0], source_width=1000, source_height=500))
+    assert plan["valid"] is False
+
+
+def test_optimization_is_opt_in():
+    for tool in (server.async_image_transformation, server.transform_image):
+        fn = server._tool_fn(tool)
+        assert inspect.signature(fn).parameters["optimize"].default is False
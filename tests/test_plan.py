@@ -0,0 +1,25 @@
+import asyncio
+
+import pytest
+
+import server
+
+
+def plan(**transform):
+    params = server._build_transform_params(**transform)
+    return asyncio.run(server._plan_for_source(params, source_width=1000, source_height=500))
+
+
+@pytest.mark.parametrize("transform", [{"contain_pixels": [100, 0]}, {"pad_pixels": [0, 100]}])
+def test_zero_size_is_a_validation_error(transform):
+    result = plan(**transform)
+    assert result["valid"] is False
+    assert result["errors"] == [f"{next(iter(transform)).split('_')[0]} must have a positive width and height"]
+
+
+def test_transform_options_are_declared_once():
+    fn = server._tool_fn(server.async_image_transformation)
+    assert "contain_pixels" in server.inspect.signature(fn).parameters
+    compact = server._with_transform_params(fn.__wrapped__, compact=True)
+    parameters = server.inspect.signature(compact).parameters
+    assert "contain" in parameters and "contain_pixels" not in parameters
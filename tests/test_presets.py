@@ -0,0 +1,22 @@
+import json
+
+import pytest
+
+import server
+
+
+def test_crop_box_requires_positive_size():
+    with pytest.raises(ValueError, match="requires a positive width"):
+        server._compile_preset("crop_box", "{}")
+    with pytest.raises(ValueError, match="requires a positive height"):
+        server._compile_preset("crop_box", json.dumps({"width": 800, "height": 0}))
+
+
+def test_crop_box_with_size():
+    transform = json.loads(server._compile_preset("crop_box", json.dumps({"height": 600, "width": 800})))
+    assert transform["crop_box"][0] == [{"pixels": 800}, {"pixels": 600}]
+
+
+def test_unknown_override_is_rejected():
+    with pytest.raises(ValueError, match="Unknown overrides"):
+        server._compile_preset("print_ready", json.dumps({"width": 1}))
@@ -0,0 +1,21 @@
+import pytest
+
+import server
+
+
+def spec():
+    variants = [
+        {"attributes": {"color": "black", "frame": "classic"}, "printAreaSizes": {"default": {"horizontalResolution": 10, "verticalResolution": 20}}},
+        {"attributes": {"color": "white", "frame": "box"}, "printAreaSizes": {"default": {"horizontalResolution": 30, "verticalResolution": 40}}},
+    ]
+    return server.ProductSpec("GLOBAL-CFP", {"sku": "GLOBAL-CFP", "variants": variants}, 0)
+
+
+def test_valid_values_that_match_no_variant_list_the_combinations():
+    with pytest.raises(ValueError, match="No variant matches") as error:
+        spec().find_variants({"Color": "Black", "frame": "box"})
+    assert "color=black, frame=classic; color=white, frame=box" in str(error.value)
+
+
+def test_partial_attributes_match():
+    assert spec().find_variants({"color": "white"}) == [1]
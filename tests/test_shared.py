@@ -0,0 +1,56 @@
+import asyncio
+import time
+
+import server
+
+
+def test_shared_work_outlives_the_starting_call_deadline():
+    async def fetch():
+        await asyncio.sleep(0.2)
+        return server._upstream_timeout(30.0)
+    
+    async def caller(task, timeout):
+        server._call_deadline.set(time.monotonic() + timeout)
+        try:
+            return await server._join_shared(task)
+        except TimeoutError:
+            return "timed out"
+    
+    async def main():
+        server._call_deadline.set(time.monotonic() + 0.05)
+        task = server._start_shared(fetch())
+        first = asyncio.ensure_future(caller(task, 0.05))
+        second = asyncio.ensure_future(caller(task, 60))
+        return await first, await second
+    
+    assert asyncio.run(main()) == ("timed out", 30.0)
+
+
+def test_reuse_existing_false_resubmits(monkeypatch):
+    submitted = []
+    
+    async def source_version(url):
+        return "v1"
+    
+    async def job_status(output_url):
+        return "queued"
+    
+    async def submit():
+        submitted.append(len(submitted))
+        return {"job_id": len(submitted), "output_url": "https://example.blob.core.windows.net/out.png"}
+    
+    monkeypatch.setattr(server, "_cache", server.MemoryCache())
+    monkeypatch.setattr(server, "_source_version", source_version)
+    monkeypatch.setattr(server, "_transform_job_status", job_status)
+    body = {"source_image_url": "https://example.com/in.png", "transform": {"resize": {"width": 10}}}
+    
+    async def main():
+        first = await server._deduplicated_transform(body, submit)
+        reused = await server._deduplicated_transform(body, submit)
+        retried = await server._deduplicated_transform(body, submit, reuse_existing=False)
+        after = await server._deduplicated_transform(body, submit)
+        return first, reused, retried, after
+    
+    first, reused, retried, after = asyncio.run(main())
+    assert (first["cache_hit"], reused["cache_hit"], retried["cache_hit"]) == (False, True, False)
+    assert retried["job_id"] == 2 and after["job_id"] == 2 and after["cache_hit"]